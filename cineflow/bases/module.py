@@ -1,14 +1,25 @@
 """Base class for API consumer clients."""
 
-from typing import List, Dict, Any
+import time
+from typing import List, Dict, Any, Callable, Iterable
 from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 from cineflow.system.logger import log
 from cineflow.system.config import Config, cfg
-from cineflow.system.misc import sanitize_name
+from cineflow.system.matcher import MediaIndex
+from cineflow.system.record import MediaRecord
 from cineflow.system.request import RequestHandler
+from cineflow.system.database import Database
 from cineflow.system.directory import DirectoryHandler
 
 
+def materialized(action: Callable) -> Callable:
+    """Mark an action which needs all items at once, a streamed input is collected before the call."""
+    action.materialized = True
+    return action
+
+
 class ModuleBase():
     """Consumer base class"""
 
@@ -24,6 +35,8 @@ class ModuleBase():
         }
         self._empty_property_allowed = False
         self._data_transforms = {}
+        self._extract = None
+        self._mapped = {'items': 0, 'seconds': 0.0}
         for key in required or []:
             if self.cfg(key):
                 continue
@@ -41,36 +54,83 @@ class ModuleBase():
             log(f"Item missing required fields: {item}")
             return {}
         # validate empty properties
-        if not self._empty_property_allowed:
-            for key, value in data.items():
-                if not value:
-                    log(
-                        f"Empty property '{key}' not allowed in {self.name} module.",
-                        level='WARNING'
-                    )
-                    return {}
-        return data
+        if not self._empty_property_allowed and not all(data.values()):
+            key = next(key for key, value in data.items() if not value)
+            log(f"Empty property '{key}' not allowed in {self.name} module.", level='WARNING')
+            return {}
+        return MediaRecord(data)
+
+    def map_many(self, items: Iterable[dict]) -> List[dict]:
+        """Interpret a batch of received items, the invalid ones are left out."""
+        started = time.perf_counter()
+        items = list(items or [])
+        results = [data for item in items if (data := self.map(item=item))]
+        elapsed = time.perf_counter() - started
+        self._mapped['items'] += len(items)
+        self._mapped['seconds'] += elapsed
+        log(f"Mapped {len(results)} of {len(items)} items in {elapsed * 1000:.1f}ms.")
+        return results
+
+    def close(self) -> None:
+        """Release the resources owned by the module."""
 
     def _map_props(self, item: dict) -> dict:
         """Map the properties of the item to the data structure."""
         if not isinstance(item, dict):
             log(f"Invalid item type: {type(item)}. Expected dict.", level='WARNING')
             return {}
-        data = {}
-        for prop, aliases in self._data_mappings.items():
-            # map the property if the name matches
-            if prop in item:
-                data[prop] = item[prop]
-            else:
-                # maps the property if the alias matches
-                for alias in aliases:
-                    if alias in item:
-                        data[prop] = item[alias]
+        if not self._extract:
+            self._extract = self._compile_mappings()
+        return self._extract(item)
+
+    def _compile_mappings(self) -> Callable:
+        """Compile the mappings and transforms once into a function which maps an item."""
+        # the property name is tried first, dotted aliases also look into nested items
+        plan = tuple(
+            (
+                prop,
+                (prop, *((alias, tuple(alias.split('.'))) if '.' in alias else alias for alias in aliases)),
+                self._data_transforms.get(prop),
+            )
+            for prop, aliases in self._data_mappings.items()
+        )
+        lookup = self._lookup
+
+        def extract(item: dict) -> dict:
+            data = {}
+            for prop, keys, transform in plan:
+                for key in keys:
+                    if not isinstance(key, tuple):
+                        if key in item:
+                            value = item[key]
+                            break
+                    elif key[0] in item:
+                        value = item[key[0]]
                         break
-            # apply any data transformations
-            if prop in self._data_transforms and data.get(prop):
-                data[prop] = self._data_transforms[prop](data[prop])
-        return data
+                    elif (value := lookup(item=item, path=key[1])) not in (None, ''):
+                        break
+                else:
+                    continue
+                # apply any data transformations
+                data[prop] = transform(value) if transform and value else value
+            return data
+        return extract
+
+    @staticmethod
+    def _lookup(item: dict, path: tuple) -> Any:
+        """Return the value at the path in the nested item, None when it is missing."""
+        value = item
+        for key in path:
+            if not isinstance(value, dict) or key not in value:
+                return None
+            value = value[key]
+        return value
+
+    @property
+    def mapping_stats(self) -> dict:
+        """Return the number of items mapped in batches and the throughput."""
+        items, seconds = self._mapped['items'], self._mapped['seconds']
+        return {'items': items, 'per_second': round(items / seconds) if seconds else 0}
 
     @property
     def mappings(self) -> Dict:
@@ -79,6 +139,7 @@ class ModuleBase():
     @mappings.setter
     def mappings(self, value: Dict) -> None:
         self._data_mappings = value
+        self._extract = None
 
     @property
     def transforms(self) -> Dict:
@@ -87,6 +148,7 @@ class ModuleBase():
     @transforms.setter
     def transforms(self, value: Dict) -> None:
         self._data_transforms = value
+        self._extract = None
 
     @property
     def empty_property_allowed(self) -> bool:
@@ -97,18 +159,40 @@ class ModuleBase():
         self._empty_property_allowed = value
 
 
+@dataclass
+class ConsumerOptions:
+    """Parallel searches of a consumer module, whether it stores its media and the title similarity to match."""
+    concurrency: int = 1
+    media_cache: bool = False
+    similarity: float = 1.0
+
+
 class ConsumerBase(ModuleBase, ABC):
     """Consumer module base class."""
 
     def __init__(self, url: str = None, config: dict = None, required: list = None) -> None:
         """Initialize the consumer module."""
         super().__init__(config=config, required=required)
-        self._url = url or self.cfg('url')
+        # a configured url wins over the default of the module, e.g. to use a replay stand-in
+        self._url = self.cfg('url', url)
         if not self._url:
             raise ValueError(f"Missing required module config '{self.name}.url'")
-        self._handler = RequestHandler(url=self._url)
+        self._options = ConsumerOptions(
+            concurrency=max(int(self.cfg('concurrency', 1)), 1),
+            similarity=float(self.cfg('similarity', 1.0))
+        )
+        pool_size = self.cfg('pool_size')
+        if self._options.concurrency > 1:
+            pool_size = max(int(pool_size or 0), self._options.concurrency)
+        self._handler = RequestHandler(url=self._url, pool_size=pool_size)
+        self.cache_time = 0
+        self.cache_policy = 'ttl'
+        if self.cfg('stale_time') is not None:
+            self._handler.stale_time = self.cfg('stale_time')
         self._kind = 'movie'
         self._limit = self.cfg('limit', 20)
+        if isinstance(self.cfg('rate_limit'), dict):
+            self.limit_rate(count=1, window=self._handler.rate_limit)
 
     @abstractmethod
     def get(self, query: Any = None) -> List[dict]:
@@ -121,29 +205,89 @@ class ConsumerBase(ModuleBase, ABC):
     def match(
         self, results: List[Dict], title: str, year: int
     ) -> dict:
-        """Match item from the results by title and year."""
-        for item in results or []:
-            if (
-                str(item.get('year')) == str(year) and
-                sanitize_name(name=item.get('title')) == sanitize_name(name=title)
-            ):
-                return item
-        return None
+        """Match item from the results by normalized title and year, similar titles match below similarity 1."""
+        index = MediaIndex(items=results, join='title', similarity=self._options.similarity)
+        return index.find({'title': title, 'year': year})
 
     def enrich(self, data: list[dict]) -> List[Dict]:
         """Extend the received data with module properties"""
-        for item in data or []:
-            if local_match := self.search(title=item.get('title'), year=item.get('year'), tmdbid=item.get('tmdbid')):
+        items = data or []
+        matches = self._stored_media(items=items)
+        missing = [index for index, match in enumerate(matches) if not match]
+        for index, match in zip(missing, self._search_items(items=[items[index] for index in missing])):
+            matches[index] = match
+        self._cache_matches(items=[items[index] for index in missing], matches=[matches[index] for index in missing])
+        for item, local_match in zip(items, matches):
+            if local_match:
                 self._update(original=item, updates=local_match)
                 log(f"Item '{item.get('title')}' ({item.get('year')}) extended.")
             else:
                 log(f"No media found for '{item.get('title')}' ({item.get('year')})")
         return data
 
+    def _search_items(self, items: List[Dict]) -> List[Dict]:
+        """Search the items, concurrently when the module allows it."""
+        if self._options.concurrency > 1 and len(items) > 1:
+            return self._search_concurrent(items=items)
+        return [
+            self.search(title=item.get('title'), year=item.get('year'), tmdbid=item.get('tmdbid'))
+            for item in items
+        ]
+
+    def _stored_media(self, items: List[Dict]) -> List[Dict]:
+        """Return the media stored for the items by TMDB id or by title and year with bulk lookups."""
+        if not self._options.media_cache or not items:
+            return [None] * len(items)
+        database = Database()
+        found = [None] * len(items)
+        if any(item.get('tmdbid') for item in items):
+            found = database.get_media_by_ids(
+                source=self.name, kind=self._kind, ids=[item.get('tmdbid') for item in items]
+            )
+        missing = [index for index, media in enumerate(found) if not media]
+        keys = self._media_keys(items=[items[index] for index in missing])
+        for index, media in zip(missing, database.get_media_many(source=self.name, keys=keys)):
+            found[index] = media
+        return found
+
+    def _store_media(self, items: List[Dict], keys: List[tuple] = None) -> None:
+        """Store the media in one batch, keyed by their own title and year unless keys are given."""
+        if self._options.media_cache and items:
+            Database().store_media_many(source=self.name, items=items, keys=keys or self._media_keys(items=items))
+
+    def _cache_matches(self, items: List[Dict], matches: List[Dict]) -> None:
+        """Store the found matches in one batch, keyed by the searched title and year."""
+        found = [(item, match) for item, match in zip(items, matches) if match]
+        if found:
+            self._store_media(
+                items=[match for _, match in found],
+                keys=self._media_keys(items=[item for item, _ in found])
+            )
+
+    def _media_keys(self, items: List[Dict]) -> List[tuple]:
+        return [(item.get('title'), item.get('year'), self._kind) for item in items]
+
+    def _search_concurrent(self, items: List[Dict]) -> List[Dict]:
+        """Search the items on a bounded thread pool, results keep the order of the items."""
+        log(f"Searching {len(items)} items with {self._options.concurrency} workers.")
+        with ThreadPoolExecutor(max_workers=self._options.concurrency, thread_name_prefix=self.name) as executor:
+            futures = [executor.submit(self._search_item, item) for item in items]
+            return [future.result() for future in futures]
+
+    def _search_item(self, item: dict) -> dict:
+        """Search a single item, a failure is logged and does not stop the batch."""
+        try:
+            return self.search(title=item.get('title'), year=item.get('year'), tmdbid=item.get('tmdbid'))
+        except Exception as e:  # pylint: disable=broad-except
+            log(f"Search failed for '{item.get('title')}' ({item.get('year')}): {e}", level='WARNING')
+            return None
+
+    @materialized
     def unique(self, data: list[dict], query: Any = None) -> List[Dict]:
         """Return items from the received data wich ones are not in the queried items"""
         return self._set_operations(data=data, query=query, operation='unique')
 
+    @materialized
     def common(self, data: list[dict], query: Any = None) -> List[Dict]:
         """Return items from the received data which ones are in the queried items"""
         return self._set_operations(data=data, query=query, operation='common')
@@ -152,24 +296,33 @@ class ConsumerBase(ModuleBase, ABC):
         if not data:
             log("No data received for operation, empty list returned.")
             return []
-        results = self.get(query=query)
-        if not results:
+        if not (index := self._query_index(query=query)):
             log("No results returned by the query, nothing to operate on.")
             return data
         to_return = []
         for d in data:
-            match = False
-            for r in results:
-                if d.get('title') == r.get('title') and d.get('year') == r.get('year'):
-                    match = True
-                    break
-            # match = any(d.get('title') == r.get('title') and d.get('year') == r.get('year') for r in results)
+            match = d in index
             if (operation == 'common' and match) or (operation == 'unique' and not match):
                 log(f"Item '{d.get('title')}' ({d.get('year')}) is {operation}, adding to the result.")
                 to_return.append(d)
         log(f"Returning {len(to_return)} items after {operation} operation.")
         return to_return
 
+    def _query_index(self, query: Any = None) -> MediaIndex:
+        """Return the index of the queried items for the set operations."""
+        return MediaIndex(
+            items=self.get(query=query), join=self.cfg('join', 'auto'), similarity=self._options.similarity
+        )
+
+    def limit_rate(self, count: float, window: float, burst: int = 1) -> None:
+        """Set the upstream rate limit, the module 'rate_limit' config takes precedence."""
+        config = self.cfg('rate_limit')
+        if isinstance(config, dict):
+            count = float(config.get('requests', count))
+            window = float(config.get('window', window))
+            burst = int(config.get('burst', burst))
+        self._handler.limit_rate(count=count, window=window, burst=burst)
+
     def _update(self, original: dict, updates: dict) -> dict:
         """Update the original dictionary with the updates."""
         for key, value in updates.items():
@@ -193,7 +346,24 @@ class ConsumerBase(ModuleBase, ABC):
 
     @cache_time.setter
     def cache_time(self, value: int) -> None:
-        self._handler.cache_time = value
+        self._handler.cache_time = int(self.cfg('cache_time', value))
+
+    @property
+    def cache_policy(self) -> str:
+        return self._handler.cache_policy
+
+    @cache_policy.setter
+    def cache_policy(self, value: str) -> None:
+        self._handler.cache_policy = self.cfg('cache_policy', value)
+
+    @property
+    def media_cache(self) -> bool:
+        return self._options.media_cache
+
+    @media_cache.setter
+    def media_cache(self, value: bool) -> None:
+        value = self.cfg('media_cache', value)
+        self._options.media_cache = value if isinstance(value, bool) else str(value).lower() in ('true', 'yes', '1')
 
     @property
     def headers(self) -> dict:
@@ -217,7 +387,23 @@ class ConsumerBase(ModuleBase, ABC):
 
     @rate_limit.setter
     def rate_limit(self, value: float) -> None:
-        self._handler.rate_limit = value
+        self.limit_rate(count=1, window=max(value, 0))
+
+    @property
+    def similarity(self) -> float:
+        return self._options.similarity
+
+    @similarity.setter
+    def similarity(self, value: float) -> None:
+        self._options.similarity = float(self.cfg('similarity', value))
+
+    @property
+    def concurrency(self) -> int:
+        return self._options.concurrency
+
+    @concurrency.setter
+    def concurrency(self, value: int) -> None:
+        self._options.concurrency = max(int(value), 1)
 
     @property
     def limit(self) -> int:
@@ -238,3 +424,7 @@ class LibraryBase(ModuleBase):
         self._handler = DirectoryHandler(directory=directory)
         self._handler.max_item_count = self.cfg("limit", 50)
         self._handler.max_item_age = self.cfg("age", 30)
+
+    def close(self) -> None:
+        """Stop the cleanup worker of the library directory."""
+        self._handler.stop()
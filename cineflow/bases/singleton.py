@@ -1,13 +1,21 @@
 """Singleton Pattern Implementation"""
 
+import threading
 from abc import ABCMeta
 
 
 class SingletonMeta(ABCMeta):
     """Singleton metaclass to ensure only one instance of a class is created."""
     _instances = {}
+    _locks = {}
+    _lock = threading.Lock()
 
     def __call__(cls, *args, **kwargs):
-        if cls not in cls._instances:
-            cls._instances[cls] = super().__call__(*args, **kwargs)
-        return cls._instances[cls]
+        if cls not in SingletonMeta._instances:
+            # one lock per class, an instance may create other singletons while it is initialized
+            with SingletonMeta._lock:
+                lock = SingletonMeta._locks.setdefault(cls, threading.Lock())
+            with lock:
+                if cls not in SingletonMeta._instances:
+                    SingletonMeta._instances[cls] = super().__call__(*args, **kwargs)
+        return SingletonMeta._instances[cls]
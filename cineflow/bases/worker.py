@@ -1,53 +1,62 @@
 """Worker base class."""
 
-import random
+import os
 from abc import ABC, abstractmethod
-from threading import Thread, Event
+from cineflow.system.scheduler import Scheduler, Job, IntervalTrigger, CronTrigger
 
 
 class WorkerBase(ABC):
-    """Base class for workers."""
+    """Base class for workers, the runs are scheduled as a job of the scheduler."""
+    HOUSEKEEPING = False
+
     def __init__(self):
         self._running = False
         self._delay = 120
-        self._thread = None
-        self._first_run = True
-        self._stop_event = Event()
+        self._cron = None
+        self._first_delay = 0
+        # spreads the runs of workers which are due at the same time
+        self._jitter = max(float(os.environ.get('SCHEDULER_JITTER', '0')), 0.0)
+        self._job = None
 
     @abstractmethod
     def run(self) -> None:
         """Worker to do."""
-        if self._first_run:
-            self._first_run = False
-            delay = random.randint(1, min(10, self._delay))
-            self._stop_event.wait(timeout=delay)
-
-    def worker(self) -> None:
-        """Worker thread for the consumer."""
-        while self._running:
-            self.run()
-            self._stop_event.wait(timeout=self._delay * 60)
 
     def start(self) -> None:
         """Start the consumer."""
         self._running = True
-        self._stop_event.clear()
-        if self._thread and self._thread.is_alive():
+        if self._job and self._job.state.active:
             return
-        self._thread = Thread(
-            target=self.worker,
-            daemon=True,
-            name=self.__class__.__name__.lower()
+        self._job = Scheduler().add(
+            Job(
+                name=self.job_name,
+                func=self.run,
+                trigger=self._trigger(),
+                jitter=self._jitter,
+                pool='housekeeping' if self.HOUSEKEEPING else 'flow'
+            ),
+            first_delay=self._first_delay
         )
-        self._thread.start()
 
     def stop(self) -> None:
         """Stop the consumer."""
         self._running = False
-        self._stop_event.set()
-        if self._thread and self._thread.is_alive():
-            self._thread.join(timeout=5)
-        self._thread = None
+        if self._job:
+            Scheduler().remove(self._job)
+        self._job = None
+
+    def reschedule(self, run_now: bool = False) -> None:
+        """Recalculate the next run with the current delay or cron, or run at once."""
+        if self._job:
+            Scheduler().reschedule(self._job, trigger=self._trigger(), run_now=run_now)
+
+    def _trigger(self) -> IntervalTrigger | CronTrigger:
+        return CronTrigger(self._cron) if self._cron else IntervalTrigger(seconds=self._delay * 60)
+
+    @property
+    def job_name(self) -> str:
+        """Get the name of the scheduled job."""
+        return self.__class__.__name__.lower()
 
     @property
     def delay(self) -> int:
@@ -4,7 +4,11 @@ import time
 from cineflow.system.logger import log
 from cineflow.system.config import Config
 from cineflow.system.database import Database
+from cineflow.system.scheduler import Scheduler
 from cineflow.system.runner import FlowManager
+from cineflow.system.upstream import SessionPool, RateLimiter, CircuitBreaker
+from cineflow.system.instances import ModulePool
+from cineflow.system.request import SingleFlight
 
 
 class MainApp:
@@ -17,7 +21,13 @@ class MainApp:
         try:
             log("Initialize singleton modules", level="MSG")
             self._components.append(Config())
+            self._components.append(Scheduler())
             self._components.append(Database())
+            self._components.append(SessionPool())
+            self._components.append(RateLimiter())
+            self._components.append(SingleFlight())
+            self._components.append(CircuitBreaker())
+            self._components.append(ModulePool())
             log("Start FlowManager", level="MSG")
             self._components.append(FlowManager())
         except Exception as e:
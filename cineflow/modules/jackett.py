@@ -23,7 +23,7 @@ class Jackett(ConsumerBase):
         super().__init__(config=config, required=['url', 'token'])
         self.cache_time = 3600
         self._category = '2000' if self._kind == "movie" else '5000'
-        self._data_mappings = {
+        self.mappings = {
             'title': ['Title'],
             'year': ['Title'],
             'link': ['Link'],
@@ -31,7 +31,7 @@ class Jackett(ConsumerBase):
             'torrent': ['Title'],
             'seeders': ['Seeders'],
         }
-        self._data_transforms = {
+        self.transforms = {
             'title': media_title,
             'year': media_year,
         }
@@ -60,8 +60,4 @@ class Jackett(ConsumerBase):
         )
         if not response.data or not isinstance(response.data, dict):
             return []
-        results = []
-        for item in sort_data(response.data.get('Results', []), param="Seeders", reverse=True):
-            if media := self.map(item=item):
-                results.append(media)
-        return results
+        return self.map_many(items=sort_data(response.data.get('Results', []), param="Seeders", reverse=True))
@@ -1,7 +1,10 @@
 """Jellyfin API consumer module."""
 
+import time
+import threading
 from typing import List, Any
 from cineflow.system.logger import log
+from cineflow.system.matcher import MediaIndex
 from cineflow.bases.module import ConsumerBase
 
 
@@ -13,9 +16,12 @@ class Jellyfin(ConsumerBase):
         - url: Jellyfin base URL (e.g., http://localhost:8096)
         - token: Jellyfin API key (required)
         - limit: Number of results to return (default: 20)
+        - lists_ttl: Seconds the user and library lists are kept before reloading (default: 3600)
+        - join: key used by unique and common: auto, tmdbid or title (default: auto)
+        - snapshot_age: Seconds the indexed library snapshot answers searches before reloading (default: 300)
 
     Functions:
-        - search: Search media for a given title.
+        - search: Search media for a given title in the library snapshot.
     """
 
     def __init__(self, config: dict = None) -> None:
@@ -26,6 +32,7 @@ class Jellyfin(ConsumerBase):
             'title': ['OriginalTitle', 'Name'],
             'year': ['ProductionYear', 'PremiereDate'],
             'jellyfinid': ['Id'],
+            'tmdbid': ['ProviderIds.Tmdb'],
         }
         self.transforms = {
             "year": lambda x: str(x)[0:4],
@@ -33,23 +40,25 @@ class Jellyfin(ConsumerBase):
         self.params = {
             "ApiKey": self.cfg("token")
         }
-        self._user_list = self._get_users()
-        self._library_list = self._get_libraries()
+        self._lists = {}
+        self._lists_lock = threading.RLock()
 
     def get(self, query: Any = None) -> List[dict]:
         """Collect media from Jellyfin."""
         query = self._parse_query(query)
+        if not query:
+            return [item.copy() for item in self._snapshot()[0]]
         if query.get("isInverse"):
             del query["isInverse"]
-            results = self._inverse_items(query_items=self._get_items(query=query))
+            results = self._inverse_items(query=query)
         else:
             results = self._get_items(query=query)
         return list({item['jellyfinid']: item for item in results}.values())
 
     def search(self, title: str, year: int, tmdbid: str = None) -> List[dict]:  # pylint: disable=arguments-differ
-        """Search media for the given title."""
-        results = self._get_items()
-        return self.match(results=results, title=title, year=year)
+        """Search media for the given title, the library snapshot answers without a request."""
+        found = self._snapshot()[1].find({'title': title, 'year': year, 'tmdbid': tmdbid})
+        return found.copy() if found else None
 
     def _parse_query(self, query: Any) -> dict:
         if not query:
@@ -58,6 +67,8 @@ class Jellyfin(ConsumerBase):
             return {"searchTerm": query}
         if not isinstance(query, dict):
             raise ValueError("Jellyfin 'query' must be a string or a dictionary.")
+        # the query of the step definition is used again on the next run
+        query = dict(query)
         if query.get("isInverse") and query.get("perUser"):
             raise ValueError("Cannot set both 'isInverse' and 'perUser' in one query.")
         if query.get("parentLibrary"):
@@ -90,7 +101,7 @@ class Jellyfin(ConsumerBase):
             response = self._handler.get(
                 endpoint=f"/Users/{u}/Items" if u else "/Items",
                 params={
-                    "fields": "OriginalTitle,ParentId",
+                    "fields": "OriginalTitle,ParentId,ProviderIds",
                     "Recursive": "true",
                     "includeItemTypes": self._kind,
                     **(query or {}),
@@ -99,12 +110,59 @@ class Jellyfin(ConsumerBase):
             if not response.data or not response.data.get('Items'):
                 continue
             results.extend(response.data.get('Items'))
-        return [self.map(item=item) for item in results]
+        return self.map_many(items=results)
+
+    def _inverse_items(self, query: dict) -> List[dict]:
+        """Return the library items not matching the query, the library is read again for the query."""
+        # a snapshot older than the queried items would count changed items on both sides
+        if not (snapshot := self._load_snapshot()):
+            raise ValueError("Jellyfin library could not be read for the inverse query.")
+        with self._lists_lock:
+            self._lists['snapshot'] = (time.monotonic(), snapshot)
+        library = snapshot[0]
+        query_ids = {item['jellyfinid'] for item in self._get_items(query=query)}
+        return [item.copy() for item in library if item['jellyfinid'] not in query_ids]
+
+    def _query_index(self, query: Any = None) -> MediaIndex:
+        """Return the index of the queried items, the snapshot index for the whole library."""
+        if not query:
+            return self._snapshot()[1]
+        return super()._query_index(query=query)
+
+    def _snapshot(self) -> tuple:
+        """Return the library items and their index, reloaded when older than the snapshot age."""
+        ttl = int(self.cfg('snapshot_age', 300))
+        if snapshot := self._cached_list(name='snapshot', loader=self._load_snapshot, ttl=ttl):
+            return snapshot
+        return [], MediaIndex(items=[], join=self.cfg('join', 'auto'), similarity=self.similarity)
+
+    def _load_snapshot(self) -> tuple | None:
+        """Load the library items and index them, None when the library is empty or could not be read."""
+        if not (items := list({item['jellyfinid']: item for item in self._get_items()}.values())):
+            log("Jellyfin library snapshot is empty, it is loaded again on the next use.", level="WARNING")
+            return None
+        log(f"Jellyfin library snapshot loaded with {len(items)} items.")
+        return items, MediaIndex(items=items, join=self.cfg('join', 'auto'), similarity=self.similarity)
+
+    @property
+    def _user_list(self) -> dict:
+        return self._cached_list(name='users', loader=self._get_users)
+
+    @property
+    def _library_list(self) -> dict:
+        return self._cached_list(name='libraries', loader=self._get_libraries)
 
-    def _inverse_items(self, query_items: List[dict]) -> List[dict]:
-        all_items = self._get_items()
-        query_ids = {item['jellyfinid'] for item in query_items}
-        return [item for item in all_items if item['jellyfinid'] not in query_ids]
+    def _cached_list(self, name: str, loader: callable, ttl: int = None) -> Any:
+        """Return a list loaded from Jellyfin, reloaded when older than the TTL, the lists TTL by default."""
+        # concurrent callers wait for one load
+        with self._lists_lock:
+            loaded, values = self._lists.get(name, (0.0, None))
+            if values is None or time.monotonic() - loaded > (int(self.cfg('lists_ttl', 3600)) if ttl is None else ttl):
+                # an empty or failed load is not kept, the last list is served and the next caller tries again
+                if reloaded := loader():
+                    self._lists[name] = (time.monotonic(), reloaded)
+                    values = reloaded
+            return values
 
     def _get_users(self):
         response = self._handler.get(
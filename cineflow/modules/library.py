@@ -47,7 +47,7 @@ class Library(LibraryBase):
                 continue
             results.append({'directory': directory.name})
         log(f"Items in library: '{len(results)}'")
-        return [self.map(item=item) for item in results]
+        return self.map_many(items=results)
 
     def put(self, data: List[Dict]) -> List[Dict]:
         """Import the media to the library."""
@@ -2,6 +2,7 @@
 
 from typing import List, Any
 from cineflow.system.logger import log
+from cineflow.system.database import Database
 from cineflow.bases.module import ConsumerBase
 
 
@@ -10,19 +11,25 @@ class Tmdb(ConsumerBase):
     TMDB API consumer module
     Configuration:
         - token: TMDB API token (required)
+        - url: TMDB API base URL (default: https://api.themoviedb.org/3)
         - kind: media type: movie, tv (default: movie)
         - limit: number of items to collect (default: 20)
         - params: additional parameters for the API request (optional)
+        - media_cache: keep the found media in the cache database (default: true)
 
     Functions:
         - get: get media from TMDB API returns the list of media items
         - search: search for media in TMDB API return the matching item or None
+          stored media are served from the cache database and refreshed in the background
     """
 
     def __init__(self, config: dict = None) -> None:
         """Initialize the TMDB consumer."""
         super().__init__(url="https://api.themoviedb.org/3", config=config, required=['token'])
         self.cache_time = 10800
+        self.cache_policy = 'refresh-ahead'
+        self.limit_rate(count=40, window=10, burst=10)
+        self.media_cache = True
         self.mappings = {
             'title': ['original_title'],
             'year': ['release_date', 'first_air_date'],
@@ -38,6 +45,8 @@ class Tmdb(ConsumerBase):
             'api_key': self.cfg('token'),
             'language': self.cfg('language', 'en-US'),
         }
+        if self.media_cache:
+            Database().register_media_refresh(source=self.name, func=self._refresh, kind=self.kind)
 
     def get(self, query: Any = None) -> List[dict]:
         """Collect media from the TMDB API."""
@@ -50,34 +59,51 @@ class Tmdb(ConsumerBase):
             )
             if not response.data or not isinstance(response.data, dict):
                 break
-            for item in response.data.get('results', []):
-                if media := self.map(item=item):
-                    if media and query and query in media.get('title'):
-                        collected.append(media)
-                    elif media and not query:
-                        collected.append(media)
-                    if len(collected) >= self.limit:
-                        break
+            for media in self.map_many(items=response.data.get('results', [])):
+                if not query or query in media.get('title'):
+                    collected.append(media)
+                if len(collected) >= self.limit:
+                    break
             page += 1
         log(f"Collected {len(collected)} items from TMDB.")
+        self._store_media(items=collected)
         return collected
 
     def search(self, title: str, year: int, tmdbid: str = None) -> dict:
-        """Search for media in TMDB."""
+        """Search for media in TMDB, stored media are served locally."""
+        if media := self._stored_media(items=[{'title': title, 'year': year, 'tmdbid': tmdbid}])[0]:
+            return media
         if tmdbid:
-            response = self._handler.get(
-                endpoint=f"/{self.kind}/{tmdbid}",
-                params={'append_to_response': 'images'}
-            )
+            media = self._details(tmdbid=tmdbid)
         else:
             response = self._handler.get(
                 endpoint=f"/search/{self.kind}",
                 params={'query': title, 'year': year}
             )
+            if not response.data or not isinstance(response.data, dict):
+                return None
+            results = self.map_many(items=response.data.get('results', []))
+            media = self.match(results=results, title=title, year=year)
+        if media:
+            self._store_media(items=[media])
+        return media
+
+    def _details(self, tmdbid: str, kind: str = None) -> dict:
+        """Get media by TMDB id, the details endpoint answers with the media itself."""
+        response = self._handler.get(
+            endpoint=f"/{kind or self.kind}/{tmdbid}",
+            params={'append_to_response': 'images'}
+        )
         if not response.data or not isinstance(response.data, dict):
             return None
-        results = []
-        for item in response.data.get('results', []):
-            if media := self.map(item=item):
-                results.append(media)
-        return self.match(results=results, title=title, year=year)
+        return self.map(item=response.data) or None
+
+    def _refresh(self, data: dict) -> dict:
+        """Re-fetch a stored media for the cache database refresh."""
+        if not data.get('tmdbid'):
+            return None
+        # the stored media may come from an instance of the other kind
+        kind = data.get('kind') or self.kind
+        if media := self._details(tmdbid=data['tmdbid'], kind=kind):
+            media.setdefault('kind', kind)
+        return media
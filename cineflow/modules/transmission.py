@@ -24,13 +24,13 @@ class Transmission(ConsumerBase):
         password = self.cfg('password', default=None)
         self._auth = (username, password) if username else None
         self._session_id = self._get_session_id()
-        self._data_mappings = {
+        self.mappings = {
             'title': ['name'],
             'year': ['name'],
             'status': ['status'],
             'percent_done': ['percentDone'],
         }
-        self._data_transforms = {
+        self.transforms = {
             'title': media_title,
             'year': media_year,
         }
@@ -45,14 +45,11 @@ class Transmission(ConsumerBase):
             log("No torrents found or invalid response from Transmission API.", level='WARNING')
             return []
         results = []
-        for item in data:
-            if media := self.map(item=item):
-                if media and query and query in media.get('title'):
-                    results.append(media)
-                elif media and not query:
-                    results.append(media)
-                else:
-                    log(f"Skipping item '{item.get('name')}' invalid or not match.", level='DEBUG')
+        for media in self.map_many(items=data):
+            if not query or query in media.get('title'):
+                results.append(media)
+            else:
+                log(f"Skipping item '{media.get('title')}' not match.", level='DEBUG')
         return results
 
     def search(self, title: str, year: int, tmdbid: str = None) -> List[dict]:  # pylint: disable=arguments-differ
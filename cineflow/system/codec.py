@@ -0,0 +1,89 @@
+"""Codecs to serialize cached data for the database."""
+
+import os
+import json
+import zlib
+import base64
+from typing import Any
+from collections.abc import Mapping
+
+
+def _mapping(data: Any) -> dict:
+    """Serialize dict-like records as JSON objects."""
+    if isinstance(data, Mapping):
+        return dict(data)
+    raise TypeError(f"Object of type {type(data).__name__} is not JSON serializable")
+
+
+class Codec:
+    """Codec storing data as compact JSON bytes."""
+    tag = 1
+    name = 'json'
+
+    def serialize(self, data: Any) -> bytes:
+        """Serialize the data to JSON bytes."""
+        return json.dumps(data, separators=(',', ':'), default=_mapping).encode('utf-8')
+
+    def deserialize(self, raw: bytes) -> Any:
+        """Deserialize the data from JSON bytes."""
+        return json.loads(raw)
+
+    def pack(self, raw: bytes) -> bytes:
+        """Convert serialized data to the stored form."""
+        return raw
+
+    def unpack(self, blob: bytes) -> bytes:
+        """Convert stored data back to the serialized form."""
+        return blob
+
+    def encode(self, data: Any) -> bytes:
+        """Serialize and pack the data."""
+        return self.pack(self.serialize(data))
+
+    def decode(self, blob: bytes) -> Any:
+        """Unpack and deserialize the data."""
+        return self.deserialize(self.unpack(blob))
+
+
+class LegacyCodec(Codec):
+    """Codec of rows written by earlier versions, base64 encoded JSON."""
+    tag = 0
+    name = 'base64'
+
+    def serialize(self, data: Any) -> bytes:
+        return bytes(json.dumps(data, default=_mapping), 'utf-8')
+
+    def pack(self, raw: bytes) -> bytes:
+        return base64.b64encode(raw)
+
+    def unpack(self, blob: bytes) -> bytes:
+        return base64.b64decode(blob)
+
+
+class ZlibCodec(Codec):
+    """Codec storing data as zlib compressed JSON bytes."""
+    tag = 2
+    name = 'zlib'
+
+    def __init__(self) -> None:
+        self._level = min(max(int(os.environ.get('CACHE_COMPRESSION', '6')), 0), 9)
+
+    def pack(self, raw: bytes) -> bytes:
+        return zlib.compress(raw, self._level)
+
+    def unpack(self, blob: bytes) -> bytes:
+        return zlib.decompress(blob)
+
+
+CODECS = {codec.tag: codec for codec in (LegacyCodec(), Codec(), ZlibCodec())}
+
+
+def get_codec(name: str = None, tag: int = None) -> Codec:
+    """Return the codec registered with the given name or tag."""
+    for codec in CODECS.values():
+        if codec.name == name or codec.tag == tag:
+            return codec
+    raise ValueError(
+        f"Unknown cache codec '{name if name is not None else tag}', "
+        f"use one of {', '.join(c.name for c in CODECS.values())}."
+    )
@@ -1,169 +1,901 @@
 """Database module for storing media information"""
 
 import os
+import sys
+import time
+import queue
 import tempfile
+import argparse
 import threading
 import sqlite3
-import json
-import base64
+import zlib
+import binascii
+from typing import Optional, Callable, List
+from pathlib import Path
+from dataclasses import dataclass, field
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
 from cineflow.system.logger import log
+from cineflow.system.codec import Codec, get_codec
+from cineflow.system.lru import LruCache
 from cineflow.bases.singleton import SingletonMeta
 from cineflow.bases.worker import WorkerBase
 
 
+@dataclass
+class CachedRequest:
+    """Cached response with the time it was stored and its ETag and Last-Modified validators."""
+    data: dict
+    added: float
+    etag: Optional[str] = None
+    modified: Optional[str] = None
+
+    @property
+    def validators(self) -> dict:
+        """Return the conditional request headers to revalidate the entry."""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.modified:
+            headers['If-Modified-Since'] = self.modified
+        return headers
+
+
+@dataclass
+class CacheSettings:
+    """Location of the cache database file, the expiry of cached requests and media and the codec of new rows."""
+    file: str
+    expire: int = 86400
+    media_expire: int = 2592000
+    codec: Codec = field(default_factory=lambda: get_codec("zlib"))
+
+    @classmethod
+    def from_env(cls) -> 'CacheSettings':
+        """Return the settings configured by the environment."""
+        directory = os.environ.get("CACHE_DIRECTORY") or tempfile.gettempdir()
+        return cls(
+            file=os.path.join(directory, "cachedb.sqlite3"),
+            expire=int(os.environ.get("CACHE_EXPIRE", "86400")),
+            media_expire=int(os.environ.get("MEDIA_EXPIRE", "2592000")),
+            codec=cls._codec(os.environ.get("CACHE_CODEC", "zlib")),
+        )
+
+    @staticmethod
+    def _codec(name: str) -> Codec:
+        """Return the configured codec, an unknown one falls back to zlib."""
+        try:
+            return get_codec(name)
+        except ValueError as e:
+            log(f"{e} Falling back to 'zlib'.", level="WARNING")
+            return get_codec("zlib")
+
+
+@dataclass
+class PoolSettings:
+    """Durability of the cache connections, the size of the reader pool and how writes are batched."""
+    synchronous: str = "NORMAL"
+    flush_interval: float = 1.0
+    flush_size: int = 200
+    readers: int = 4
+
+    @classmethod
+    def from_env(cls) -> 'PoolSettings':
+        """Return the settings configured by the environment."""
+        return cls(
+            synchronous=os.environ.get("CACHE_SYNCHRONOUS", "NORMAL").upper(),
+            flush_interval=max(float(os.environ.get("CACHE_FLUSH_INTERVAL", "1")), 0.0),
+            flush_size=max(int(os.environ.get("CACHE_FLUSH_SIZE", "200")), 1),
+            readers=max(int(os.environ.get("CACHE_READERS", "4")), 1),
+        )
+
+
+@dataclass
+class MediaRefresh:
+    """Refreshers of stored media per source and kind, the refresh age and budget and the media backing off."""
+    age: int = 604800
+    budget: int = 50
+    refreshers: dict = field(default_factory=dict)
+    backoff: dict = field(default_factory=dict)
+
+
+@dataclass
+class RefreshState:
+    """Registered refreshers of cached requests and media, the requests being refreshed and the worker running them."""
+    ahead: float = 0.2
+    media: MediaRefresh = field(default_factory=MediaRefresh)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    requests: dict = field(default_factory=dict)
+    running: set = field(default_factory=set)
+    executor: ThreadPoolExecutor = field(
+        default_factory=lambda: ThreadPoolExecutor(max_workers=2, thread_name_prefix="refresh")
+    )
+
+
+@dataclass
+class CleanupState:
+    """Interval and last run of the expired entry cleanup, the size limit and the access times waiting to be written."""
+    interval: int = 14400
+    last: float = 0.0
+    max_size: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    accessed: dict = field(default_factory=lambda: {'media': {}, 'request': {}})
+
+
+class ConnectionPool:
+    """Pooled reader connections of the cache database and the writer thread committing the queued writes."""
+
+    def __init__(self, file: str, settings: PoolSettings) -> None:
+        self._file = file
+        self._settings = settings
+        self._lock = threading.Lock()
+        self._readers = []
+        self._queue = queue.Queue()
+        self._writer = None
+        self.closed = False
+
+    def start(self) -> None:
+        """Start the writer thread."""
+        self._writer = threading.Thread(target=self._write_behind, daemon=True, name="dbwriter")
+        self._writer.start()
+
+    def flush(self, timeout: float = None) -> bool:
+        """Wait until the queued writes are committed."""
+        if not self._writer or not self._writer.is_alive():
+            return self._queue.empty()
+        done = threading.Event()
+        self.notify(callback=done.set)
+        return done.wait(timeout=timeout)
+
+    def notify(self, callback: Callable) -> None:
+        """Call the callback on the writer thread once the writes queued before it are committed."""
+        self._queue.put((None, callback, None))
+
+    def pending(self) -> int:
+        """Return the number of queued writes."""
+        return self._queue.qsize()
+
+    def close(self) -> None:
+        """Commit the queued writes and close the connections."""
+        self.closed = True
+        self._queue.put(None)
+        if self._writer:
+            self._writer.join(timeout=30)
+        with self._lock:
+            readers, self._readers = self._readers, []
+        for conn in readers:
+            conn.close()
+
+    def connect(self) -> Optional[sqlite3.Connection]:
+        """Open a connection in WAL mode, readers do not block the writer and the other way round."""
+        try:
+            conn = sqlite3.connect(self._file, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute(f"PRAGMA synchronous={self._settings.synchronous};")
+            return conn
+        except sqlite3.Error as e:
+            log(f"Cache database connection error cache database not usable: {e}", level="WARNING")
+            return None
+
+    @contextmanager
+    def reader(self):
+        """Borrow a connection from the pool, one thread uses a connection at a time."""
+        with self._lock:
+            conn = self._readers.pop() if self._readers else None
+        if conn is None:
+            conn = self.connect()
+        try:
+            yield conn
+        finally:
+            if conn is not None:
+                with self._lock:
+                    if not self.closed and len(self._readers) < self._settings.readers:
+                        self._readers.append(conn)
+                        conn = None
+            if conn is not None:
+                conn.close()
+
+    def write(self, sql: str, params: tuple | list, message: str = None) -> None:
+        """Queue a statement for the writer thread, a list of parameters is written with executemany."""
+        if self.closed:
+            log(f"Cache database closed, write dropped: {message or sql}", level="WARNING")
+            return
+        self._queue.put((sql, params, message))
+
+    def _write_behind(self) -> None:
+        """Commit the queued statements in batches, a write waits at most the flush interval."""
+        conn = self.connect()
+        if conn is None:
+            # the queue is still drained, a flush must not wait for writes which cannot be committed
+            log("Cache database not writable, queued writes are discarded.", level="WARNING")
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self._settings.flush_interval
+            while len(batch) < self._settings.flush_size and batch[-1] and batch[-1][0]:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            running = batch[-1] is not None
+            if conn is not None:
+                self._commit(conn=conn, statements=[item for item in batch if item and item[0]])
+            for item in batch:
+                if item and not item[0]:
+                    item[1]()
+        if conn:
+            conn.close()
+
+    def _commit(self, conn: sqlite3.Connection, statements: list) -> None:
+        """Run the statements in one transaction, a failing batch is retried statement by statement."""
+        if not statements:
+            return
+        try:
+            with conn:
+                for sql, params, _ in statements:
+                    if isinstance(params, list):
+                        conn.executemany(sql, params)
+                    else:
+                        conn.execute(sql, params)
+        except (AttributeError, sqlite3.Error) as e:
+            if len(statements) == 1:
+                log(f"Error writing to cache DB: {e}", level="WARNING")
+                return
+            for statement in statements:
+                self._commit(conn=conn, statements=[statement])
+            return
+        for _, _, message in statements:
+            if message:
+                log(message)
+
+
 class Database(WorkerBase, metaclass=SingletonMeta):
-    # TO-DO: Add matedate refresh based on added time
     """Database class for storing media information and request caching."""
+    HOUSEKEEPING = True
+    MEDIA_CHUNK = 300
+    DELETE_CHUNK = 500
+    VACUUM_PAGES = 256
+    BACKUP_PAGES = 1024
+    EVICT_ROUNDS = 100
 
     def __init__(self):
         super().__init__()
-        self.delay = 240
-        self._file = os.path.join(tempfile.gettempdir(), "cachedb.sqlite3")
-        self._lock = threading.Lock()
-        self._conn = None
-        self._cursor = None
-        self._default_expire = int(os.environ.get("CACHE_EXPIRE", "86400"))
+        self.delay = int(os.environ.get("CACHE_REFRESH_INTERVAL", "5"))
+        self._settings = CacheSettings.from_env()
         try:
-            self._conn = sqlite3.connect(self._file, check_same_thread=False)
-            self._cursor = self._conn.cursor()
-            self.create_tables()
-        except sqlite3.Error as e:
-            log(f"Cache database connection error cache database not usable: {e}", level="WARNING")
-        log(f"Cache database initialized with file '{os.path.basename(self._file)}'")
+            os.makedirs(os.path.dirname(self._settings.file), exist_ok=True)
+        except OSError as e:
+            log(f"Error creating cache directory '{os.path.dirname(self._settings.file)}': {e}", level="WARNING")
+        warm_start = not os.path.exists(self._settings.file)
+        self._pool = ConnectionPool(file=self._settings.file, settings=PoolSettings.from_env())
+        self._memory = LruCache(max_bytes=int(os.environ.get("CACHE_MEMORY_SIZE", "64")) * 1024 * 1024)
+        # written requests the memory cannot hold, kept until the writer committed them
+        self._unflushed = {}
+        self._cleanup = CleanupState(
+            interval=int(os.environ.get("CACHE_CLEANUP_INTERVAL", "240")) * 60,
+            max_size=max(int(os.environ.get("CACHE_MAX_SIZE", "256")), 0) * 1024 * 1024
+        )
+        self._refresh = RefreshState(
+            ahead=min(max(float(os.environ.get("CACHE_REFRESH_AHEAD", "0.2")), 0.0), 1.0),
+            media=MediaRefresh(
+                age=int(os.environ.get("MEDIA_REFRESH_AGE", "604800")),
+                budget=max(int(os.environ.get("MEDIA_REFRESH_BUDGET", "50")), 0)
+            )
+        )
+        self.create_tables()
+        self._pool.start()
+        log(f"Cache database initialized with file '{os.path.basename(self._settings.file)}'")
+        if warm_start and (snapshot := os.environ.get("CACHE_SNAPSHOT")):
+            self.import_snapshot(path=snapshot)
         self.start()
 
     def create_tables(self):
-        """Create tables in database"""
-        if os.path.getsize(self._file) == 0:
-            log("Creating cache DB tables.")
-            with self._lock:
+        """Create the tables and migrate them to the latest schema version."""
+        migrations = (self._migrate_tables, self._migrate_media_key, self._migrate_accessed, self._migrate_media_id)
+        with self._pool.reader() as conn:
+            try:
+                version = conn.execute("PRAGMA user_version;").fetchone()[0]
+            except (AttributeError, sqlite3.Error) as e:
+                log(f"Error reading cache DB schema version: {e}", level="WARNING")
+                return
+            for number, migration in enumerate(migrations[version:], start=version + 1):
                 try:
-                    self._cursor.execute("""
-                        CREATE TABLE IF NOT EXISTS media (
-                            title TEXT NOT NULL,
-                            year INTEGER NOT NULL,
-                            kind TEXT NOT NULL,
-                            source TEXT NOT NULL,
-                            data BLOB NOT NULL,
-                            added REAL NOT NULL
-                        );
-                    """.strip())
-                    self._conn.commit()
-                    self._cursor.execute("""
-                        CREATE TABLE IF NOT EXISTS request (
-                            hash TEXT NOT NULL PRIMARY KEY,
-                            data BLOB NOT NULL,
-                            added REAL NOT NULL
-                        );
-                    """.strip())
-                    self._conn.commit()
-                    log("Cache DB tables created successfully.")
-                except (AttributeError, sqlite3.Error) as e:
-                    log(f"Error creating cache DB tables: {e}", level="WARNING")
+                    conn.execute("BEGIN;")
+                    migration(conn)
+                    conn.execute(f"PRAGMA user_version = {number};")
+                    conn.commit()
+                    log(f"Cache DB migrated to schema version {number}.")
+                except sqlite3.Error as e:
+                    conn.rollback()
+                    log(f"Error migrating cache DB to schema version {number}: {e}", level="WARNING")
+                    return
+            self._auto_vacuum(conn=conn)
+
+    def _migrate_tables(self, conn: sqlite3.Connection) -> None:
+        """Create the tables, tables of versions before the schema versioning get the missing columns."""
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS media (
+                title TEXT NOT NULL,
+                year INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                source TEXT NOT NULL,
+                data BLOB NOT NULL,
+                added REAL NOT NULL
+            );
+        """.strip())
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS request (
+                hash TEXT NOT NULL PRIMARY KEY,
+                data BLOB NOT NULL,
+                added REAL NOT NULL
+            );
+        """.strip())
+        self._add_columns(conn=conn, table="media", columns={'codec': 'INTEGER NOT NULL DEFAULT 0'})
+        self._add_columns(
+            conn=conn,
+            table="request",
+            columns={'etag': 'TEXT', 'modified': 'TEXT', 'codec': 'INTEGER NOT NULL DEFAULT 0'}
+        )
+
+    def _migrate_media_key(self, conn: sqlite3.Connection) -> None:
+        """Key the media table by source, kind, title and year and index the cleanup column."""
+        conn.execute("""
+            CREATE TABLE media_keyed (
+                title TEXT NOT NULL,
+                year INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                source TEXT NOT NULL,
+                data BLOB NOT NULL,
+                added REAL NOT NULL,
+                codec INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (source, kind, title, year)
+            );
+        """.strip())
+        # duplicates piled up without a key, the latest row wins
+        conn.execute(
+            "INSERT OR REPLACE INTO media_keyed (title, year, kind, source, data, added, codec) "
+            "SELECT title, year, kind, source, data, added, codec FROM media ORDER BY added;"
+        )
+        conn.execute("DROP TABLE media;")
+        conn.execute("ALTER TABLE media_keyed RENAME TO media;")
+        conn.execute("CREATE INDEX IF NOT EXISTS media_added ON media (added);")
+        conn.execute("CREATE INDEX IF NOT EXISTS request_added ON request (added);")
+
+    def _migrate_accessed(self, conn: sqlite3.Connection) -> None:
+        """Track the last access of the rows to evict the least recently used ones."""
+        for table in ("media", "request"):
+            self._add_columns(conn=conn, table=table, columns={'accessed': 'REAL NOT NULL DEFAULT 0'})
+            conn.execute(f"UPDATE {table} SET accessed = added;")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed ON {table} (accessed);")
+
+    def _migrate_media_id(self, conn: sqlite3.Connection) -> None:
+        """Key the media by their TMDB id as well, a media stays a single row when its title changes."""
+        self._add_columns(conn=conn, table="media", columns={'tmdbid': 'TEXT'})
+        conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS media_tmdbid ON media (source, kind, tmdbid) WHERE tmdbid IS NOT NULL;"
+        )
+
+    @staticmethod
+    def _auto_vacuum(conn: sqlite3.Connection) -> None:
+        """Switch the database to incremental vacuum, an existing file is rebuilt once."""
+        try:
+            if conn.execute("PRAGMA auto_vacuum;").fetchone()[0] == 2:
+                return
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+            conn.execute("VACUUM;")
+            log("Cache DB switched to incremental vacuum.")
+        except (AttributeError, sqlite3.Error) as e:
+            log(f"Error enabling incremental vacuum on cache DB: {e}", level="WARNING")
+
+    @staticmethod
+    def _add_columns(conn: sqlite3.Connection, table: str, columns: dict) -> None:
+        """Add the missing columns to a table created by an earlier version."""
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table});").fetchall()}
+        for name, kind in columns.items():
+            if name not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {kind};")
+                log(f"Added column '{name}' to cache DB table '{table}'.")
 
     def store_media(self, source: str, data: dict) -> None:
         """Add movie to the database"""
-        if not data or not source:
-            log(f"Empty data or source cannot store in cache: {data}, {source}")
+        self.store_media_many(source=source, items=[data])
+
+    def store_media_many(self, source: str, items: List[dict], keys: List[tuple] = None) -> None:
+        """Add media items to the database in one transaction, keys default to the title, year and kind of the items."""
+        if not items or not source:
+            log(f"Empty data or source cannot store in cache: {items}, {source}")
             return
-        if not data.get('title') or not data.get('year') or not data.get('kind'):
-            log(f"Invalid data for media cannot store in cache: {data}")
+        rows = []
+        added = dt.now().timestamp()
+        codec = self._settings.codec
+        for data, key in zip(items, keys or [None] * len(items)):
+            if data and not key:
+                key = (data.get('title'), data.get('year'), data.get('kind'))
+            if not data or not (key := self._media_key(*key)):
+                log(f"Invalid data for media cannot store in cache: {data}")
+                continue
+            tmdbid = str(data['tmdbid']) if data.get('tmdbid') else None
+            rows.append((source, *key, tmdbid, codec.encode(data), added, added, codec.tag))
+        if not rows:
             return
-        with self._lock:
-            bytes_data = base64.b64encode(bytes(json.dumps(data), "utf-8"))
-            try:
-                self._cursor.execute(
-                    "INSERT OR REPLACE INTO media (source, title, year, kind, data, added) VALUES (?, ?, ?, ?, ?, ?);",
-                    (source, data.get('title'), data.get('year'), data.get('kind'), bytes_data, dt.now().timestamp(),)
-                )
-                self._conn.commit()
-                log(f"Added media to cache DB: {data.title} ({data.year})")
-            except (AttributeError, sqlite3.Error) as e:
-                log(f"Error storing media in cache DB: {e}", level="WARNING")
+        self._pool.write(
+            "INSERT OR REPLACE INTO media (source, title, year, kind, tmdbid, data, added, accessed, codec) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);",
+            rows,
+            f"Added {len(rows)} media to cache DB from '{source}'"
+        )
 
     def get_media(self, source: str, title: str, year: int, kind: str) -> dict:
         """Get movie by title"""
-        with self._lock:
-            try:
-                self._cursor.execute(
-                    "SELECT data,added FROM media WHERE source = ? AND title = ? AND year = ? AND kind = ?;",
-                    (source, title, year, kind,)
-                )
-                data = self._cursor.fetchone()
-            except (AttributeError, sqlite3.Error) as e:
-                log(f"Error fetching media from cache DB: {e}", level="WARNING")
-                return None
-            if not data:
-                log(f"Media not found in cache DB: {title} ({year})")
-                return None
-            if data[1] + self._default_expire < dt.now().timestamp():
-                log(f"Media expired in cache DB: {title} ({year})")
-                return None
-            return json.loads(base64.b64decode(data[0]).decode("utf-8"))
+        return self.get_media_many(source=source, keys=[(title, year, kind)])[0]
+
+    def get_media_many(self, source: str, keys: List[tuple]) -> List[Optional[dict]]:
+        """Get media by (title, year, kind) keys with one query per chunk, missing and expired keys are None."""
+        requested = [self._media_key(*key) for key in keys or []]
+        keys = list(dict.fromkeys(key for key in requested if key))
+        found = {}
+        for start in range(0, len(keys), self.MEDIA_CHUNK):
+            chunk = keys[start:start + self.MEDIA_CHUNK]
+            rows = self._select_media(
+                f"WITH k (title, year, kind) AS (VALUES {', '.join(['(?, ?, ?)'] * len(chunk))}) "
+                "SELECT m.title, m.year, m.kind, m.tmdbid, m.data, m.codec FROM k JOIN media m "
+                "ON m.source = ? AND m.kind = k.kind AND m.title = k.title AND m.year = k.year "
+                "WHERE m.added >= ?;",
+                (
+                    *(value for key in chunk for value in key), source,
+                    dt.now().timestamp() - self._settings.media_expire
+                ),
+                source=source
+            )
+            found.update({key[:3]: data for key, data in rows})
+        log(f"Found {len(found)} of {len(keys)} media in cache DB for '{source}'.")
+        return [found.get(key) for key in requested]
 
-    def store_request(self, rhash: str, data: dict) -> None:
-        """Store request data in the database."""
+    def get_media_by_ids(self, source: str, kind: str, ids: List[str]) -> List[Optional[dict]]:
+        """Get media by their TMDB ids with one query per chunk, missing and expired ids are None."""
+        requested = [str(tmdbid) if tmdbid else None for tmdbid in ids or []]
+        ids = list(dict.fromkeys(tmdbid for tmdbid in requested if tmdbid))
+        found = {}
+        for start in range(0, len(ids), self.MEDIA_CHUNK):
+            chunk = ids[start:start + self.MEDIA_CHUNK]
+            rows = self._select_media(
+                "SELECT title, year, kind, tmdbid, data, codec FROM media "
+                f"WHERE source = ? AND kind = ? AND tmdbid IN ({', '.join(['?'] * len(chunk))}) AND added >= ?;",
+                (source, kind, *chunk, dt.now().timestamp() - self._settings.media_expire),
+                source=source
+            )
+            found.update({key[3]: data for key, data in rows})
+        log(f"Found {len(found)} of {len(ids)} media by id in cache DB for '{source}'.")
+        return [found.get(tmdbid) for tmdbid in requested]
+
+    def stale_media(self, source: str, age: int, limit: int, kind: str = None) -> List[tuple]:
+        """Return the (title, year, kind) keys and data of the oldest media stored longer ago than the age."""
+        rows = self._select_media(
+            "SELECT title, year, kind, tmdbid, data, codec FROM media "
+            "WHERE source = ? AND (? IS NULL OR kind = ?) AND added < ? ORDER BY added LIMIT ?;",
+            (source, kind, kind, dt.now().timestamp() - age, limit),
+        )
+        return [(key[:3], data) for key, data in rows]
+
+    def register_media_refresh(self, source: str, func: Callable, kind: str = None) -> None:
+        """Register a function which re-fetches a stored media of the source and kind, it returns the data or None."""
+        with self._refresh.lock:
+            self._refresh.media.refreshers[(source, kind)] = func
+
+    def store_request(
+        self, rhash: str, data: dict, etag: str = None, modified: str = None, expire: int = None
+    ) -> None:
+        """Store request data and its HTTP validators in memory and queue the write to the database."""
         if not data or not rhash:
             log(f"Empty data or hash cannot store in cache: {data}, {rhash}")
             return
-        with self._lock:
-            bytes_data = base64.b64encode(bytes(json.dumps(data), "utf-8"))
-            try:
-                self._cursor.execute(
-                    "INSERT OR REPLACE INTO request (hash, data, added) VALUES (?, ?, ?);",
-                    (rhash, bytes_data, dt.now().timestamp(),)
-                )
-                self._conn.commit()
-                log(f"Added request to cache DB: {rhash}")
-            except (AttributeError, sqlite3.Error) as e:
-                log(f"Error storing request in cache DB: {e}", level="WARNING")
+        raw = self._settings.codec.serialize(data)
+        entry = CachedRequest(data=data, added=dt.now().timestamp(), etag=etag, modified=modified)
+        self._pool.write(
+            "INSERT OR REPLACE INTO request (hash, data, added, accessed, etag, modified, codec) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?);",
+            (
+                rhash, self._settings.codec.pack(raw), entry.added, entry.added, etag, modified,
+                self._settings.codec.tag,
+            ),
+            f"Added request to cache DB: {rhash}"
+        )
+        self._keep(rhash=rhash, entry=entry, size=len(raw), expire=expire)
 
     def get_request(self, rhash: str, expire: int = None) -> dict:
         """Get request data by hash."""
-        with self._lock:
+        if not (entry := self.get_request_entry(rhash=rhash)):
+            return None
+        if not expire:
+            expire = self._settings.expire
+        if entry.added + expire < dt.now().timestamp():
+            log(f"Request expired in cache DB: {rhash}")
+            return None
+        return entry.data
+
+    def get_request_entry(self, rhash: str, expire: int = None) -> Optional[CachedRequest]:
+        """Get request data with its validators by hash, expired entries included."""
+        self._access(table="request", key=rhash)
+        if entry := self._memory.get(rhash) or self._unflushed.get(rhash):
+            return entry
+        with self._pool.reader() as conn:
             try:
-                self._cursor.execute(
-                    "SELECT data,added FROM request WHERE hash = ?;",
+                data = conn.execute(
+                    "SELECT data,added,etag,modified,codec FROM request WHERE hash = ?;",
                     (rhash,)
-                )
-                data = self._cursor.fetchone()
+                ).fetchone()
             except (AttributeError, sqlite3.Error) as e:
                 log(f"Error fetching request from cache DB: {e}", level="WARNING")
                 return None
-            if not data:
-                log(f"Request not found in cache DB: {rhash}")
-                return None
-            if not expire:
-                expire = self._default_expire
-            if data[1] + expire < dt.now().timestamp():
-                log(f"Request expired in cache DB: {rhash}")
-                return None
-            log(f"Request found in cache DB: {rhash}")
-            return json.loads(base64.b64decode(data[0]).decode("utf-8"))
+        if not data:
+            log(f"Request not found in cache DB: {rhash}")
+            return None
+        decoded, size = self._decode(blob=data[0], tag=data[4])
+        if decoded is None:
+            return None
+        log(f"Request found in cache DB: {rhash}")
+        entry = CachedRequest(data=decoded, added=data[1], etag=data[2], modified=data[3])
+        self._remember(rhash=rhash, entry=entry, size=size, expire=expire)
+        return entry
+
+    def touch_request(self, rhash: str, entry: CachedRequest = None, expire: int = None) -> None:
+        """Mark a revalidated request as fresh again, the entry is kept in memory even if it was evicted."""
+        added = dt.now().timestamp()
+        self._pool.write(
+            "UPDATE request SET added = ?, accessed = ? WHERE hash = ?;",
+            (added, added, rhash,),
+            f"Refreshed request in cache DB: {rhash}"
+        )
+        if entry := self._memory.get(rhash) or self._unflushed.get(rhash) or entry:
+            size = self._memory.size(rhash) or len(self._settings.codec.serialize(entry.data))
+            entry = CachedRequest(data=entry.data, added=added, etag=entry.etag, modified=entry.modified)
+            self._keep(rhash=rhash, entry=entry, size=size, expire=expire)
+
+    def register_refresh(self, rhash: str, expire: int, func: Callable) -> None:
+        """Register a function which refreshes a cached request ahead of its expiry."""
+        with self._refresh.lock:
+            self._refresh.requests[rhash] = (expire, func, time.time())
+
+    def refresh(self, rhash: str, func: Callable) -> None:
+        """Refresh a cached request in the background."""
+        with self._refresh.lock:
+            if rhash in self._refresh.running:
+                return
+        self._refresh.executor.submit(self._run_refresh, rhash, func)
 
     def run(self):
-        """Run the database cleanup."""
-        log(f"Start database cleanup for db '{os.path.basename(self._file)}'")
-        self._table_cleanup("media")
-        self._table_cleanup("request")
-        log(f"End database cleanup for db '{os.path.basename(self._file)}'")
+        """Run the refresh-ahead of cached requests and the periodic database cleanup."""
+        self._refresh_expiring()
+        self._flush_access()
+        if time.time() - self._cleanup.last >= self._cleanup.interval:
+            self._cleanup.last = time.time()
+            log(f"Start database cleanup for db '{os.path.basename(self._settings.file)}'")
+            self._table_cleanup("media", expire=self._settings.media_expire)
+            self._table_cleanup("request", expire=self._settings.expire)
+            log(f"End database cleanup for db '{os.path.basename(self._settings.file)}'")
+        self._refresh_media()
+        self._evict()
+        self._vacuum()
+
+    def flush(self, timeout: float = None) -> bool:
+        """Wait until the queued writes are committed."""
+        return self._pool.flush(timeout=timeout)
+
+    def export_snapshot(self, path: str) -> bool:
+        """Write a consistent copy of the cache database to the given file."""
+        self._flush_access()
+        self.flush()
+        temp = f"{path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            target = sqlite3.connect(temp)
+            try:
+                with self._pool.reader() as conn:
+                    conn.backup(target, pages=self.BACKUP_PAGES)
+                # a snapshot is a single file without write-ahead log
+                target.execute("PRAGMA journal_mode=DELETE;")
+            finally:
+                target.close()
+            os.replace(temp, path)
+        except (AttributeError, OSError, sqlite3.Error) as e:
+            log(f"Error exporting cache snapshot to '{path}': {e}", level="WARNING")
+            if os.path.exists(temp):
+                os.remove(temp)
+            return False
+        log(f"Cache snapshot exported to '{path}' ({os.path.getsize(path) // 1024} kB).", level="INFO")
+        return True
+
+    def import_snapshot(self, path: str) -> bool:
+        """Replace the cached data with a snapshot written by export_snapshot."""
+        if not os.path.isfile(path):
+            log(f"Cache snapshot '{path}' not found.", level="WARNING")
+            return False
+        self.flush()
+        try:
+            source = sqlite3.connect(f"{Path(path).resolve().as_uri()}?mode=ro", uri=True)
+            try:
+                if source.execute("PRAGMA quick_check;").fetchone()[0] != "ok":
+                    raise sqlite3.DatabaseError("snapshot failed the integrity check")
+                with self._pool.reader() as conn:
+                    source.backup(conn, pages=self.BACKUP_PAGES)
+            finally:
+                source.close()
+        except (AttributeError, sqlite3.Error) as e:
+            log(f"Error importing cache snapshot '{path}': {e}", level="WARNING")
+            return False
+        self._memory.clear()
+        self._unflushed.clear()
+        # snapshots of earlier versions are migrated to the current schema
+        self.create_tables()
+        log(f"Cache snapshot imported from '{path}'.", level="INFO")
+        return True
+
+    def stats(self) -> dict:
+        """Return usage statistics of the cache."""
+        return {'memory': self._memory.stats(), 'pending_writes': self._pool.pending()}
 
     def close(self):
-        """Close the database connection."""
-        if self._conn:
-            self._conn.close()
-            log(f"Database connection closed for '{os.path.basename(self._file)}'")
+        """Flush the queued writes and close the database connections."""
+        log(f"Cache stats: {self.stats()}")
+        self._refresh.executor.shutdown(wait=False, cancel_futures=True)
+        if self._pool.closed:
+            return
+        self._flush_access()
+        self._pool.close()
+        log(f"Database connection closed for '{os.path.basename(self._settings.file)}'")
 
-    def _table_cleanup(self, table: str):
-        """Cleanup old entries from the specified table."""
-        with self._lock:
+    def _refresh_expiring(self) -> None:
+        """Refresh the registered requests which are read recently and expire before the next run."""
+        with self._refresh.lock:
+            refreshers = list(self._refresh.requests.items())
+        now = time.time()
+        refreshed = 0
+        for rhash, (expire, func, registered) in refreshers:
+            # forget requests which are not read anymore
+            if registered + expire * 2 < now:
+                with self._refresh.lock:
+                    self._refresh.requests.pop(rhash, None)
+                continue
+            if not (added := self._request_added(rhash=rhash)):
+                continue
+            if added + expire - now > max(expire * self._refresh.ahead, self.delay * 60):
+                continue
+            self._run_refresh(rhash=rhash, func=func)
+            refreshed += 1
+        if refreshed:
+            log(f"Refreshed {refreshed} cached requests ahead of expiry.")
+
+    def _refresh_media(self) -> None:
+        """Re-fetch the oldest media past the refresh age, at most the refresh budget per source, kind and run."""
+        media = self._refresh.media
+        now = time.time()
+        with self._refresh.lock:
+            refreshers = list(media.refreshers.items())
+            # rows of media which kept failing are removed by the cleanup after they expire
+            for key in [key for key, (_, retry) in media.backoff.items() if retry < now - self._settings.media_expire]:
+                del media.backoff[key]
+            waiting = {key for key, (_, retry) in media.backoff.items() if retry > now}
+        for (source, kind), func in refreshers:
+            refreshed, keys = [], []
+            stale = self.stale_media(source=source, age=media.age, limit=media.budget + len(waiting), kind=kind)
+            for key, data in [row for row in stale if (source, *row[0]) not in waiting][:media.budget]:
+                if item := self._refresh_item(source=source, key=key, data=data, func=func):
+                    refreshed.append(item)
+                    keys.append(key)
+            if refreshed:
+                # the refreshed media keep the key they were stored with, the title can differ from the mapped one
+                self.store_media_many(source=source, items=refreshed, keys=keys)
+                log(f"Refreshed {len(refreshed)} media from '{source}'.", level="INFO")
+
+    def _refresh_item(self, source: str, key: tuple, data: dict, func: Callable) -> Optional[dict]:
+        """Re-fetch a stored media, a failed one backs off for twice as long as the last time."""
+        try:
+            item = func(data)
+        except Exception as e:  # pylint: disable=broad-except
+            log(f"Error refreshing media '{data.get('title')}' from '{source}': {e}", level="WARNING")
+            item = None
+        with self._refresh.lock:
+            if item:
+                self._refresh.media.backoff.pop((source, *key), None)
+                return item
+            failures = self._refresh.media.backoff.get((source, *key), (0, 0.0))[0] + 1
+            delay = self._refresh.media.age * 2 ** min(failures - 1, 5)
+            self._refresh.media.backoff[(source, *key)] = (failures, time.time() + delay)
+        log(f"Media '{data.get('title')}' from '{source}' not refreshed, next try in {delay}s.")
+        return None
+
+    def _run_refresh(self, rhash: str, func: Callable) -> None:
+        with self._refresh.lock:
+            if rhash in self._refresh.running:
+                return
+            self._refresh.running.add(rhash)
+        try:
+            func()
+        except Exception as e:  # pylint: disable=broad-except
+            log(f"Error refreshing cached request {rhash}: {e}", level="WARNING")
+        finally:
+            with self._refresh.lock:
+                self._refresh.running.discard(rhash)
+
+    def _remember(self, rhash: str, entry: CachedRequest, size: int, expire: int = None) -> None:
+        """Keep the entry in memory until it expires for its cache time."""
+        expires = entry.added + (expire or self._settings.expire)
+        if expires < dt.now().timestamp():
+            return
+        self._memory.put(key=rhash, value=entry, size=size, expires=expires)
+
+    def _keep(self, rhash: str, entry: CachedRequest, size: int, expire: int = None) -> None:
+        """Remember an entry after its write is queued, an entry the memory cannot hold is kept until committed."""
+        self._remember(rhash=rhash, entry=entry, size=size, expire=expire)
+        if self._memory.size(rhash):
+            self._unflushed.pop(rhash, None)
+            return
+        self._unflushed[rhash] = entry
+
+        def committed():
+            if self._unflushed.get(rhash) is entry:
+                self._unflushed.pop(rhash, None)
+        self._pool.notify(callback=committed)
+
+    def _decode(self, blob: bytes, tag: int) -> tuple:
+        """Decode a stored row and return it with its serialized size, unreadable rows are a cache miss."""
+        try:
+            codec = get_codec(tag=tag)
+            raw = codec.unpack(blob)
+            return codec.deserialize(raw), len(raw)
+        except (ValueError, zlib.error, binascii.Error) as e:
+            log(f"Error decoding cache DB entry: {e}", level="WARNING")
+            return None, 0
+
+    def _select_media(self, sql: str, params: tuple, source: str = None) -> List[tuple]:
+        """Run a media query and return the keys with the decoded data, the access is recorded for the source."""
+        with self._pool.reader() as conn:
+            try:
+                rows = conn.execute(sql, params).fetchall()
+            except (AttributeError, sqlite3.Error) as e:
+                log(f"Error fetching media from cache DB: {e}", level="WARNING")
+                return []
+        selected = []
+        for title, year, kind, tmdbid, blob, tag in rows:
+            if (data := self._decode(blob=blob, tag=tag)[0]) is None:
+                continue
+            selected.append(((title, year, kind, tmdbid), data))
+            if source:
+                self._access(table="media", key=(source, title, year, kind))
+        return selected
+
+    @staticmethod
+    def _media_key(title: str, year: int, kind: str) -> Optional[tuple]:
+        """Return the media key with the year as stored, invalid keys are None."""
+        try:
+            year = int(year)
+        except (TypeError, ValueError):
+            return None
+        if not title or not kind:
+            return None
+        return (str(title), year, str(kind))
+
+    def _request_added(self, rhash: str) -> Optional[float]:
+        if entry := self._memory.get(rhash) or self._unflushed.get(rhash):
+            return entry.added
+        with self._pool.reader() as conn:
+            try:
+                row = conn.execute("SELECT added FROM request WHERE hash = ?;", (rhash,)).fetchone()
+            except (AttributeError, sqlite3.Error) as e:
+                log(f"Error fetching request from cache DB: {e}", level="WARNING")
+                return None
+        return row[0] if row else None
+
+    def _access(self, table: str, key) -> None:
+        """Remember the access of a row, the access times are written in batches."""
+        with self._cleanup.lock:
+            self._cleanup.accessed[table][key] = dt.now().timestamp()
+
+    def _flush_access(self) -> None:
+        """Write the remembered access times with one statement per table."""
+        with self._cleanup.lock:
+            accessed, self._cleanup.accessed = self._cleanup.accessed, {'media': {}, 'request': {}}
+        if accessed['request']:
+            self._pool.write(
+                "UPDATE request SET accessed = ? WHERE hash = ?;",
+                [(when, rhash) for rhash, when in accessed['request'].items()]
+            )
+        if accessed['media']:
+            self._pool.write(
+                "UPDATE media SET accessed = ? WHERE source = ? AND title = ? AND year = ? AND kind = ?;",
+                [(when, *key) for key, when in accessed['media'].items()]
+            )
+
+    def _used_size(self) -> Optional[int]:
+        """Return the bytes used by the rows, free pages waiting for the vacuum are not counted."""
+        with self._pool.reader() as conn:
             try:
-                self._cursor.execute(
-                    f"DELETE FROM {table} WHERE added < ?;",
-                    (dt.now().timestamp() - self._default_expire,)
+                pages = [conn.execute(f"PRAGMA {name};").fetchone()[0] for name in ("page_count", "freelist_count")]
+                return (pages[0] - pages[1]) * conn.execute("PRAGMA page_size;").fetchone()[0]
+            except (AttributeError, sqlite3.Error) as e:
+                log(f"Error reading cache DB size: {e}", level="WARNING")
+                return None
+
+    def _evict(self) -> None:
+        """Delete the least recently accessed rows in chunks until the cache fits its maximum size."""
+        if not self._cleanup.max_size or not (size := self._used_size()) or size <= self._cleanup.max_size:
+            return
+        log(f"Cache DB uses {size // 1024} kB of {self._cleanup.max_size // 1024} kB, evicting least recently used.")
+        for _ in range(self.EVICT_ROUNDS):
+            if (cutoff := self._evict_cutoff()) is None:
+                break
+            for table in ("request", "media"):
+                self._pool.write(
+                    f"DELETE FROM {table} WHERE rowid IN "
+                    f"(SELECT rowid FROM {table} WHERE accessed <= ? ORDER BY accessed LIMIT ?);",
+                    (cutoff, self.DELETE_CHUNK,)
                 )
-                self._conn.commit()
-                log(f"Cleaned up table '{table}'")
+            self.flush()
+            if (size := self._used_size()) is None or size <= self._cleanup.max_size:
+                break
+        log(f"Cache DB uses {(size or 0) // 1024} kB after eviction.", level="INFO")
+
+    def _evict_cutoff(self) -> Optional[float]:
+        """Return the access time of the last row in the next chunk of least recently used rows."""
+        with self._pool.reader() as conn:
+            try:
+                return conn.execute(
+                    "SELECT MAX(accessed) FROM (SELECT accessed FROM ("
+                    "SELECT accessed FROM request UNION ALL SELECT accessed FROM media"
+                    ") ORDER BY accessed LIMIT ?);",
+                    (self.DELETE_CHUNK,)
+                ).fetchone()[0]
+            except (AttributeError, sqlite3.Error) as e:
+                log(f"Error selecting cache DB rows to evict: {e}", level="WARNING")
+                return None
+
+    def _vacuum(self) -> None:
+        """Give the free pages back to the file system a few pages per transaction."""
+        with self._pool.reader() as conn:
+            try:
+                free = conn.execute("PRAGMA freelist_count;").fetchone()[0]
+                for _ in range(0, free, self.VACUUM_PAGES):
+                    # executescript steps the pragma to the end, execute frees a single page
+                    conn.executescript(f"PRAGMA incremental_vacuum({self.VACUUM_PAGES});")
+            except (AttributeError, sqlite3.Error) as e:
+                log(f"Error vacuuming cache DB: {e}", level="WARNING")
+                return
+        if free:
+            log(f"Cache DB vacuumed {free} free pages.")
+
+    def _table_cleanup(self, table: str, expire: int):
+        """Cleanup old entries from the specified table in small chunks."""
+        expired = dt.now().timestamp() - expire
+        with self._pool.reader() as conn:
+            try:
+                count = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE added < ?;", (expired,)).fetchone()[0]
             except (AttributeError, sqlite3.Error) as e:
                 log(f"Error cleaning up table '{table}': {e}", level="WARNING")
+                return
+        for _ in range(0, count, self.DELETE_CHUNK):
+            self._pool.write(
+                f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE added < ? LIMIT ?);",
+                (expired, self.DELETE_CHUNK,)
+            )
+            self.flush()
+        log(f"Cleaned up {count} entries from table '{table}'")
+
+
+def main() -> None:
+    """Export or import a snapshot of the cache database."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('action', choices=['export', 'import'])
+    parser.add_argument('snapshot', help="snapshot file to write or read")
+    args = parser.parse_args()
+    database = Database()
+    if args.action == 'export':
+        done = database.export_snapshot(path=args.snapshot)
+    else:
+        done = database.import_snapshot(path=args.snapshot)
+    database.close()
+    database.stop()
+    sys.exit(0 if done else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,6 +13,7 @@ from cineflow.bases.worker import WorkerBase
 
 class DirectoryHandler(WorkerBase):
     """Directory handler class."""
+    HOUSEKEEPING = True
     DEFAULT_MIN_ITEM_AGE = 30
     DEFAULT_MIN_ITEM_COUNT = 10
 
@@ -75,6 +76,11 @@ class DirectoryHandler(WorkerBase):
             log(f"Failed to removing: {e}", level='WARNING')
         return False
 
+    @property
+    def job_name(self) -> str:
+        """Get the name of the scheduled job, one cleanup job runs per directory."""
+        return f"directory:{self._path}"
+
     def run(self):
         """Run method for WorkerBase to run libraray cleanup periodicly."""
         log(f"Start library cleanup for path '{self._path}'")
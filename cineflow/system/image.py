@@ -5,6 +5,7 @@ from dataclasses import dataclass
 import requests
 from PIL import Image, ImageOps, ImageDraw, UnidentifiedImageError
 from cineflow.system.logger import log
+from cineflow.system.upstream import SessionPool
 
 
 @dataclass
@@ -66,10 +67,10 @@ class ImageHandler():
 
     def _load(self, url: str) -> Image.Image:
         try:
-            response = requests.get(url, stream=True, timeout=10)
-            response.raise_for_status()
-            img = Image.open(response.raw)
-            img = img.resize(self._scale)
+            with SessionPool().session(url=url).get(url, stream=True, timeout=10) as response:
+                response.raise_for_status()
+                img = Image.open(response.raw)
+                img = img.resize(self._scale)
             log(f"Image loaded successfully from '{url}'")
         except (requests.RequestException, UnidentifiedImageError, OSError) as e:
             log(f"Error loading image: {e}", level='WARNING')
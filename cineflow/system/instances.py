@@ -0,0 +1,136 @@
+"""This module provides a pool of module instances shared by the flows."""
+
+import os
+import copy
+import json
+import time
+import hashlib
+import threading
+from dataclasses import dataclass, field
+from cineflow.system.logger import log
+from cineflow.system.config import cfg
+from cineflow.system.misc import load_module, pop_idle
+from cineflow.bases.module import ModuleBase
+from cineflow.bases.singleton import SingletonMeta
+
+
+@dataclass
+class PooledModule:
+    """Module instance kept by the pool, when it was last used and how often."""
+    name: str
+    instance: ModuleBase
+    last_used: float = field(default_factory=time.monotonic)
+    uses: int = 0
+
+
+class ModulePool(metaclass=SingletonMeta):
+    """Registry of module instances keyed by module name and effective configuration."""
+    IDLE_RUNS = 3
+    MIN_IDLE = 3600
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._classes = {}
+        self._modules = {}
+        self._creating = {}
+        self._intervals = {}
+        self._created = 0
+        self._evicted = 0
+
+    def get(self, name: str, config: dict = None) -> ModuleBase | None:
+        """Return the instance of the module for the step config, created on first use."""
+        if not (module := self._module_class(name=name)):
+            return None
+        key = self.key(name=name, config=config)
+        self._evict_idle(keep=key)
+        with self._lock:
+            creating = self._creating.setdefault(key, threading.Lock())
+        # other keys are not blocked while a module connects to its upstream
+        with creating:
+            with self._lock:
+                pooled = self._modules.get(key)
+            if not pooled:
+                pooled = PooledModule(name=name, instance=module(config=copy.deepcopy(config or {})))
+                with self._lock:
+                    self._modules[key] = pooled
+                    self._created += 1
+                log(f"Module '{name}' instance created for the pool.")
+        with self._lock:
+            pooled.last_used = time.monotonic()
+            pooled.uses += 1
+        return pooled.instance
+
+    def expect(self, name: str, interval: float | None) -> None:
+        """Register the seconds between the runs of a flow, None when the flow is removed."""
+        with self._lock:
+            if interval:
+                self._intervals[name] = float(interval)
+            else:
+                self._intervals.pop(name, None)
+
+    @property
+    def idle_timeout(self) -> float:
+        """Return the seconds before an unused instance is closed."""
+        if idle := os.environ.get('MODULE_POOL_IDLE'):
+            return max(int(idle), 0)
+        # instances survive a few runs of the least frequent flow
+        with self._lock:
+            longest = max(self._intervals.values(), default=0)
+        return max(self.IDLE_RUNS * longest, self.MIN_IDLE)
+
+    @staticmethod
+    def key(name: str, config: dict = None) -> str:
+        """Return the pool key of the module from its step and global configuration."""
+        effective = json.dumps({'step': config or {}, 'global': cfg(key=name) or {}}, sort_keys=True, default=str)
+        return f"{name}:{hashlib.md5(effective.encode()).hexdigest()}"
+
+    def stats(self) -> dict:
+        """Return usage statistics of the pooled instances."""
+        now = time.monotonic()
+        with self._lock:
+            modules = {
+                key: {
+                    'uses': pooled.uses,
+                    'idle': round(now - pooled.last_used, 1),
+                    'mapping': pooled.instance.mapping_stats,
+                }
+                for key, pooled in self._modules.items()
+            }
+        return {
+            'modules': modules, 'created': self._created, 'evicted': self._evicted, 'idle_timeout': self.idle_timeout
+        }
+
+    def close(self) -> None:
+        """Close every pooled instance."""
+        log(f"Module pool stats: {self.stats()}")
+        with self._lock:
+            modules, self._modules = list(self._modules.values()), {}
+        for pooled in modules:
+            self._close(pooled)
+        log("Module pool closed.")
+
+    def _module_class(self, name: str) -> type | None:
+        with self._lock:
+            if name in self._classes:
+                return self._classes[name]
+        module = load_module(name)
+        with self._lock:
+            self._classes[name] = module
+        return module
+
+    def _evict_idle(self, keep: str = None) -> None:
+        """Close instances which were not used for longer than the idle timeout."""
+        timeout = self.idle_timeout
+        with self._lock:
+            evicted = pop_idle(self._modules, timeout=timeout, keep=keep)
+            self._evicted += len(evicted)
+        for pooled in evicted.values():
+            log(f"Module '{pooled.name}' instance evicted after being idle.")
+            self._close(pooled)
+
+    @staticmethod
+    def _close(pooled: PooledModule) -> None:
+        try:
+            pooled.instance.close()
+        except Exception as e:  # pylint: disable=broad-except
+            log(f"Error closing module '{pooled.name}': {e}", level='WARNING')
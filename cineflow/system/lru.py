@@ -0,0 +1,91 @@
+"""In-process least recently used cache bounded by size."""
+
+import time
+import threading
+from typing import Any, Optional
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+
+
+@dataclass
+class LruStats:
+    """Hits, misses, evictions and expirations counted by an LRU cache."""
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+
+class LruCache:
+    """Thread-safe LRU cache, entries are bounded by their total size in bytes and may expire."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self._max_bytes = max(int(max_bytes), 0)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._stats = LruStats()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the value of the key and mark it as recently used."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats.misses += 1
+                return None
+            value, size, expires = entry
+            if expires is not None and expires < time.time():
+                self._remove(key, size)
+                self._stats.expirations += 1
+                self._stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats.hits += 1
+            return value
+
+    def put(self, key: str, value: Any, size: int, expires: Optional[float] = None) -> None:
+        """Store the value, least recently used entries are evicted to stay within the size limit."""
+        if size > self._max_bytes:
+            self.pop(key)
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key, self._entries[key][1])
+            self._entries[key] = (value, size, expires)
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                old_key, (_, old_size, _) = next(iter(self._entries.items()))
+                self._remove(old_key, old_size)
+                self._stats.evictions += 1
+
+    def size(self, key: str) -> int:
+        """Return the size of the stored key, zero if it is not cached."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[1] if entry else 0
+
+    def pop(self, key: str) -> None:
+        """Remove the key from the cache."""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key, self._entries[key][1])
+
+    def clear(self) -> None:
+        """Remove every entry from the cache."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        """Return usage statistics of the cache."""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self._max_bytes,
+                **asdict(self._stats),
+            }
+
+    def _remove(self, key: str, size: int) -> None:
+        del self._entries[key]
+        self._bytes -= size
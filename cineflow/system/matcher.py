@@ -0,0 +1,123 @@
+"""This module provides the index used to join media lists by provider id or by title and year."""
+
+import re
+import unicodedata
+from functools import lru_cache
+from collections import Counter, defaultdict
+from typing import Iterable
+
+JOINS = ('auto', 'tmdbid', 'title')
+ARTICLES = ('the', 'a', 'an')
+ROMAN = {
+    numeral: str(number) for number, numeral in enumerate(
+        ('i', 'ii', 'iii', 'iv', 'v', 'vi', 'vii', 'viii', 'ix', 'x',
+         'xi', 'xii', 'xiii', 'xiv', 'xv', 'xvi', 'xvii', 'xviii', 'xix', 'xx'), start=1
+    )
+}
+APOSTROPHES = re.compile(r"['’`]")
+PUNCTUATION = re.compile(r"[^\w\s]|_")
+
+
+@lru_cache(maxsize=65536)
+def normalize_title(title: str) -> str:
+    """Return the title in the form used to compare media, accents, punctuation and leading articles removed."""
+    text = unicodedata.normalize('NFKD', str(title))
+    text = ''.join(char for char in text if not unicodedata.combining(char)).casefold()
+    text = PUNCTUATION.sub(' ', APOSTROPHES.sub('', text.replace('&', ' and ')))
+    words = [ROMAN.get(word, word) for word in text.split()]
+    if len(words) > 1 and words[0] in ARTICLES:
+        words = words[1:]
+    return ' '.join(words)
+
+
+def title_key(item: dict) -> tuple | None:
+    """Return the normalized title and year of the item."""
+    if not item.get('title') or not item.get('year'):
+        return None
+    return normalize_title(str(item['title'])), str(item['year'])
+
+
+def media_id(item: dict) -> str | None:
+    """Return the TMDB id of the item as a string."""
+    value = item.get('tmdbid')
+    return str(value) if value not in (None, '') else None
+
+
+def trigrams(title: str) -> set:
+    """Return the three character sequences of the padded title."""
+    padded = f"  {title} "
+    return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+
+def _numbers(title: str) -> tuple:
+    return tuple(word for word in title.split() if word.isdigit())
+
+
+class MediaIndex:
+    """Hash index of media items by TMDB id and by normalized title and year, with optional fuzzy title lookup."""
+
+    def __init__(self, items: Iterable[dict], join: str = 'auto', similarity: float = 1.0) -> None:
+        if join not in JOINS:
+            raise ValueError(f"Join key '{join}' must be one of {', '.join(JOINS)}.")
+        if not 0 < float(similarity) <= 1:
+            raise ValueError(f"Similarity '{similarity}' must be greater than 0 and at most 1.")
+        self._join = join
+        self._similarity = float(similarity)
+        self._ids = {}
+        self._titles = {}
+        # trigrams are only indexed within the same year, the candidates of a lookup stay few
+        self._grams = defaultdict(set)
+        self._sizes = {}
+        for item in items or []:
+            if (key := media_id(item)) is not None:
+                self._ids.setdefault(key, item)
+            if (key := title_key(item)) is not None and key not in self._titles:
+                self._titles[key] = item
+                if self._similarity < 1:
+                    self._index_grams(key=key)
+
+    def find(self, item: dict) -> dict | None:
+        """Return the indexed item matching the item, None when there is no match."""
+        key = media_id(item) if self._join != 'title' else None
+        if key is not None and (found := self._ids.get(key)):
+            return found
+        if self._join == 'tmdbid' or (title := title_key(item)) is None:
+            return None
+        if not (found := self._titles.get(title)) and self._similarity < 1:
+            found = self._fuzzy(key=title)
+        # with ids on both sides a title match of another media does not count
+        if found and key is not None and media_id(found) not in (None, key):
+            return None
+        return found
+
+    def _index_grams(self, key: tuple) -> None:
+        title, year = key
+        grams = trigrams(title)
+        self._sizes[key] = len(grams)
+        for gram in grams:
+            self._grams[(year, gram)].add(title)
+
+    def _fuzzy(self, key: tuple) -> dict | None:
+        """Return the item of the same year with the most similar title above the threshold."""
+        title, year = key
+        grams = trigrams(title)
+        counts = Counter()
+        for gram in grams:
+            counts.update(self._grams.get((year, gram), ()))
+        # sequels differ in a number only, they are never similar enough
+        scored = [
+            (2 * common / (len(grams) + self._sizes[(candidate, year)]), candidate)
+            for candidate, common in counts.items()
+            if _numbers(candidate) == _numbers(title)
+        ]
+        scored = [(score, candidate) for score, candidate in scored if score >= self._similarity]
+        if not scored:
+            return None
+        _, candidate = max(scored)
+        return self._titles[(candidate, year)]
+
+    def __contains__(self, item: dict) -> bool:
+        return self.find(item) is not None
+
+    def __len__(self) -> int:
+        return max(len(self._ids), len(self._titles))
@@ -1,6 +1,7 @@
 """Miscellaneous functions for the system library."""
 import importlib
 import re
+import time
 from pathlib import Path
 
 
@@ -15,7 +16,8 @@ def sort_data(data: list, param: str, reverse: bool = False) -> list:
 
 
 def __title_groups(title: str) -> None:
-    result = re.search(r'(.+)\.([12]\d\d\d)\.', title)
+    # the year is followed by the release tags or ends the name
+    result = re.search(r'(.+)\.([12]\d\d\d)(?:\.|$)', title)
     if not result or len(groups := result.groups()) < 2:
         return None
     return groups
@@ -74,6 +76,15 @@ def load_module(name: str) -> object:
     return None
 
 
+def pop_idle(entries: dict, timeout: float, keep: str = None) -> dict:
+    """Remove and return the entries whose last_used is older than the timeout, a zero timeout keeps all."""
+    if not timeout:
+        return {}
+    now = time.monotonic()
+    expired = [key for key, entry in entries.items() if key != keep and now - entry.last_used > timeout]
+    return {key: entries.pop(key) for key in expired}
+
+
 def _evaluate_null_logic(left: str, right: str, expression: str) -> bool:
     if expression == 'exists':
         return left is not None
@@ -0,0 +1,93 @@
+"""This module provides the compact record type of the media items passed between flow steps."""
+
+from typing import Any, Iterator
+from collections.abc import MutableMapping
+
+FIELDS = (
+    'title', 'year', 'kind', 'tmdbid', 'jellyfinid', 'poster', 'link', 'size', 'seeders', 'torrent',
+    'directory', 'status', 'percent_done', 'transmission_status',
+)
+_SLOTS = frozenset(FIELDS)
+
+
+class MediaRecord(MutableMapping):
+    """Media item used like a dict, the common fields are kept in slots and the others in an overflow dict."""
+    __slots__ = FIELDS + ('_extra',)
+
+    def __init__(self, data: dict = None, **fields) -> None:
+        self._extra = None
+        for values in (data, fields):
+            if not values:
+                continue
+            # known fields are assigned directly, only the unknown keys go through the overflow
+            for key, value in values.items():
+                if key in _SLOTS:
+                    setattr(self, key, value)
+                elif self._extra is None:
+                    self._extra = {key: value}
+                else:
+                    self._extra[key] = value
+
+    def __getitem__(self, key: str) -> Any:
+        if key in _SLOTS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key in _SLOTS:
+            setattr(self, key, value)
+        elif self._extra is None:
+            self._extra = {key: value}
+        else:
+            self._extra[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        if key in _SLOTS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        for name in FIELDS:
+            if hasattr(self, name):
+                yield name
+        if self._extra:
+            yield from self._extra
+
+    def __len__(self) -> int:
+        return sum(map(self._has, FIELDS)) + len(self._extra or ())
+
+    def __bool__(self) -> bool:
+        # checked for every mapped item, stops at the first field which is set
+        return bool(self._extra) or any(map(self._has, FIELDS))
+
+    def _has(self, name: str) -> bool:
+        return hasattr(self, name)
+
+    def __contains__(self, key: object) -> bool:
+        if key in _SLOTS:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Return the value of the key, the default when it is missing."""
+        if key in _SLOTS:
+            return getattr(self, key, default)
+        return self._extra.get(key, default) if self._extra else default
+
+    def copy(self) -> 'MediaRecord':
+        """Return a shallow copy of the record."""
+        return MediaRecord(self)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
@@ -0,0 +1,185 @@
+"""Record upstream traffic to an archive and replay it without network access."""
+
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+from typing import Optional
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import requests
+from requests.structures import CaseInsensitiveDict
+from cineflow.system.logger import log
+from cineflow.bases.singleton import SingletonMeta
+
+SECRET_PARAMS = re.compile(r'(?i)(api_?key|token|password|secret)')
+SKIPPED_HEADERS = {'content-length', 'content-encoding', 'transfer-encoding', 'connection', 'set-cookie'}
+
+
+def traffic_key(method: str, url: str, params: dict = None, body=None) -> str:
+    """Return the key of a request from its method, path, params and body, secrets are left out."""
+    params = {
+        key: str(value) for key, value in (params or {}).items()
+        if value is not None and not SECRET_PARAMS.search(key)
+    }
+    canonical = json.dumps([method.upper(), urlsplit(url).path, params, body], sort_keys=True, default=str)
+    return hashlib.md5(canonical.encode()).hexdigest()
+
+
+class TrafficArchive(metaclass=SingletonMeta):
+    """Archive of recorded upstream responses, used in record or replay mode."""
+    MODES = ('record', 'replay')
+
+    def __init__(self, file: str = None, mode: str = None, scale: float = None) -> None:
+        self._mode = (mode or os.environ.get('REQUEST_MODE', '')).lower()
+        self._file = file or os.environ.get(
+            'REQUEST_ARCHIVE', os.path.join(os.environ.get("CFG_DIRECTORY", "/config"), "traffic.jsonl")
+        )
+        self._scale = max(float(scale if scale is not None else os.environ.get('REQUEST_REPLAY_SCALE', '1')), 0)
+        self._lock = threading.Lock()
+        self._records = {}
+        self._positions = {}
+        if self._mode and self._mode not in self.MODES:
+            raise ValueError(f"Request mode must be one of {', '.join(self.MODES)}.")
+        if self._mode == 'replay':
+            self._load()
+        elif self._mode == 'record':
+            log(f"Recording upstream traffic to '{self._file}'.", level='INFO')
+
+    @property
+    def recording(self) -> bool:
+        return self._mode == 'record'
+
+    @property
+    def replaying(self) -> bool:
+        return self._mode == 'replay'
+
+    def record(self, method: str, url: str, kwargs: dict, response: requests.Response) -> None:
+        """Append the response of the request to the archive."""
+        record = {
+            'key': traffic_key(method, url, kwargs.get('params'), self._body(kwargs)),
+            'method': method,
+            'path': urlsplit(url).path,
+            'status': response.status_code,
+            'headers': {k: v for k, v in response.headers.items() if k.lower() not in SKIPPED_HEADERS},
+            'body': response.text,
+            'latency': round(response.elapsed.total_seconds(), 4),
+        }
+        with self._lock:
+            try:
+                with open(self._file, mode='a', encoding='UTF-8') as file:
+                    file.write(json.dumps(record) + '\n')
+            except OSError as e:
+                log(f"Error recording request to '{self._file}': {e}", level='WARNING')
+
+    def replay(self, method: str, url: str, kwargs: dict) -> requests.Response:
+        """Return the recorded response of the request after its scaled latency."""
+        key = traffic_key(method, url, kwargs.get('params'), self._body(kwargs))
+        return self.response(key=key, url=url)
+
+    def response(self, key: str, url: str = '') -> requests.Response:
+        """Return the next recorded response for the key, a 404 response if it was not recorded."""
+        if not (record := self.lookup(key=key)):
+            log(f"No recorded response for '{url}'.", level='WARNING')
+            record = {'status': 404, 'headers': {}, 'body': '', 'latency': 0}
+        time.sleep(record['latency'] * self._scale)
+        response = requests.Response()
+        response.status_code = record['status']
+        response.headers = CaseInsensitiveDict(record['headers'])
+        response._content = record['body'].encode('utf-8')  # pylint: disable=protected-access
+        response.encoding = 'utf-8'
+        response.url = url
+        return response
+
+    def lookup(self, key: str) -> Optional[dict]:
+        """Return the next recorded response for the key, the last one repeats."""
+        with self._lock:
+            if not (records := self._records.get(key)):
+                return None
+            position = self._positions.get(key, 0)
+            self._positions[key] = min(position + 1, len(records) - 1)
+            return records[position]
+
+    @staticmethod
+    def _body(kwargs: dict):
+        """Return the request body the same way requests picks it."""
+        return kwargs.get('data') or kwargs.get('json')
+
+    def _load(self) -> None:
+        try:
+            with open(self._file, mode='r', encoding='UTF-8') as file:
+                for line in file:
+                    if line.strip():
+                        record = json.loads(line)
+                        self._records.setdefault(record['key'], []).append(record)
+        except (OSError, ValueError, KeyError) as e:
+            raise ValueError(f"Error loading traffic archive '{self._file}': {e}") from e
+        log(f"Replaying {len(self._records)} recorded requests from '{self._file}'.", level='INFO')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Local HTTP stand-in for upstream servers answering with recorded responses."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        self._respond()
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        self._respond()
+
+    def do_PUT(self) -> None:  # pylint: disable=invalid-name
+        self._respond()
+
+    def log_message(self, format, *args) -> None:  # pylint: disable=redefined-builtin
+        log(f"Stand-in {self.address_string()} {format % args}")
+
+    def _respond(self) -> None:
+        parts = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        key = traffic_key(self.command, parts.path, params, self._read_body())
+        response = TrafficArchive().response(key=key, url=self.path)
+        self.send_response(response.status_code)
+        for name, value in response.headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(response.content)))
+        self.end_headers()
+        self.wfile.write(response.content)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return None
+        raw = self.rfile.read(length)
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return {key: values[-1] for key, values in parse_qs(raw.decode('utf-8')).items()}
+
+
+def main() -> None:
+    """Serve a traffic archive as a local HTTP stand-in for the recorded upstreams."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('archive', help="traffic archive recorded with REQUEST_MODE=record")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--scale', type=float, default=1.0, help="latency multiplier, 0 answers at once")
+    args = parser.parse_args()
+    try:
+        TrafficArchive(file=args.archive, mode='replay', scale=args.scale)
+    except ValueError as e:
+        log(str(e), level='ERROR')
+        sys.exit(1)
+    server = ThreadingHTTPServer((args.host, args.port), StandInHandler)
+    log(f"Stand-in server listening on http://{args.host}:{args.port}", level='INFO')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
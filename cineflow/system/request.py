@@ -2,14 +2,23 @@
 
 
 import os
+import json
 import time
+import random
 import hashlib
-from typing import Optional
-from dataclasses import dataclass
+import threading
+from functools import partial
+from typing import Optional, Callable, Any
+from dataclasses import dataclass, field
+from datetime import datetime as dt, timezone
+from email.utils import parsedate_to_datetime
 from json import JSONDecodeError
 import requests
 from cineflow.system.logger import log
-from cineflow.system.database import Database as Db
+from cineflow.bases.singleton import SingletonMeta
+from cineflow.system.database import Database as Db, CachedRequest
+from cineflow.system.upstream import SessionPool, RateLimiter, CircuitBreaker, CircuitOpenError
+from cineflow.system.replay import TrafficArchive
 
 
 @dataclass
@@ -21,19 +30,39 @@ class RequestResponse:
     headers: dict
 
 
+@dataclass
+class RetryPolicy:
+    """Retries of failed and throttled requests and the base delay of the retry backoff."""
+    retries: int = 2
+    backoff: float = 0.5
+    throttle_retries: int = 3
+
+    @classmethod
+    def from_env(cls) -> 'RetryPolicy':
+        """Return the policy configured by the environment."""
+        return cls(
+            retries=max(int(os.environ.get('REQUEST_RETRIES', '2')), 0),
+            backoff=max(float(os.environ.get('REQUEST_RETRY_BACKOFF', '0.5')), 0),
+            throttle_retries=max(int(os.environ.get('REQUEST_THROTTLE_RETRIES', '3')), 0),
+        )
+
+
 class RequestHandler:
     """Class to handle requests."""
     DEFAULT_HEADERS = {
         'Accept': 'application/json',
         'Content-Type': 'application/json;charset=utf-8',
     }
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+    RETRY_STATUSES = (500, 502, 503, 504)
 
-    def __init__(self, url: Optional[str] = None) -> None:
+    def __init__(self, url: Optional[str] = None, pool_size: Optional[int] = None) -> None:
         """Initialize the request handler."""
         self._url = (url or '').rstrip('/')
+        self._pool_size = pool_size
         self._params = {}
         self._headers = self.DEFAULT_HEADERS
-        self._rate_limiter = RateLimiter()
+        self._retry = RetryPolicy.from_env()
         self._cache_handler = CacheHandler(cache_time=0)
         self._ok_statuses = {200, 201, 202, 204}  # HTTP OK statuses
 
@@ -54,24 +83,54 @@ class RequestHandler:
         # merge default headers with user headers without overwriting critical keys
         kwargs['params'] = {**self._params, **kwargs.get("params", {})}
         kwargs['headers'] = {**self._headers, **kwargs.get("headers", {})}
+        refresh = partial(self._refresh, method, full_url, **kwargs)
+        self._cache_handler.track(method, full_url, refresh=refresh, **kwargs)
         # return cached response if available
-        if cached := self._cache_handler.read(method, full_url, **kwargs):
-            return RequestResponse(data=cached, status=200, cookies={}, headers={})
-        # respect API rate limits
-        self._rate_limiter.wait()
-        # shoot the request
+        cached = self._cache_handler.lookup(method, full_url, **kwargs)
+        if cached and self._cache_handler.is_fresh(cached):
+            return RequestResponse(data=cached.data, status=200, cookies={}, headers={})
+        if cached and self._cache_handler.is_servable(cached):
+            log(f"Serving stale response for '{full_url}' while refreshing it.")
+            self._cache_handler.refresh(method, full_url, func=refresh, **kwargs)
+            return RequestResponse(data=cached.data, status=200, cookies={}, headers={})
+        return self._fetch_once(method, full_url, cached=cached, **kwargs)
+
+    def _refresh(self, method: str, full_url: str, **kwargs) -> RequestResponse:
+        """Fetch the request again for the cache, the current entry is revalidated."""
+        cached = self._cache_handler.lookup(method, full_url, **kwargs)
+        return self._fetch_once(method, full_url, cached=cached, **kwargs)
+
+    def _fetch_once(self, method: str, full_url: str, cached: CachedRequest = None, **kwargs) -> RequestResponse:
+        if method not in SingleFlight.METHODS:
+            return self._fetch(method, full_url, cached=cached, **kwargs)
+        # identical requests in flight share one upstream call
+        return SingleFlight().do(
+            key=SingleFlight.key(method, full_url, kwargs),
+            func=lambda: self._fetch(method, full_url, cached=cached, **kwargs),
+        )
+
+    def _fetch(self, method: str, full_url: str, cached: CachedRequest = None, **kwargs) -> RequestResponse:
+        """Request the upstream, an expired cache entry is revalidated with its validators."""
+        conditional = cached.validators if cached else {}
         try:
-            response = requests.request(
-                method=method,
-                url=full_url,
-                timeout=int(os.environ.get('REQUEST_TIMEOUT', '15')),
-                **kwargs
-            )
+            response = self._send(method, full_url, **{**kwargs, 'headers': {**kwargs['headers'], **conditional}})
             if not self._ok_statuses:
                 response.raise_for_status()
+        except CircuitOpenError as e:
+            log(f"Request skipped '{full_url}': {e}")
+            return RequestResponse(data=None, status=0, cookies={}, headers={})
         except (requests.exceptions.RequestException, requests.exceptions.Timeout) as e:
             log(f"Request error '{full_url}': {e}", level='WARNING')
             return RequestResponse(data=None, status=0, cookies={}, headers={})
+        if conditional and response.status_code == 304:
+            log(f"Cached response for '{full_url}' not modified.")
+            self._cache_handler.revalidated(method, full_url, entry=cached, **kwargs)
+            return RequestResponse(
+                data=cached.data,
+                status=200,
+                cookies=response.cookies.get_dict(),
+                headers=response.headers
+            )
         if self._ok_statuses and response.status_code not in self._ok_statuses:
             log(f"Unexpected status code {response.status_code} for '{full_url}'", level='WARNING')
             return RequestResponse(data=None, status=response.status_code, cookies={}, headers={})
@@ -84,7 +143,9 @@ class RequestHandler:
         except JSONDecodeError:
             log(f"Response is not JSON: {response.text}")
             data = response.text.strip()
-        self._cache_handler.write(method, url=full_url, resp_data=data, **kwargs)
+        self._cache_handler.write(
+            method, url=full_url, resp_data=data, validators=response.headers, **kwargs
+        )
         return RequestResponse(
             data=data,
             status=response.status_code,
@@ -92,6 +153,65 @@ class RequestHandler:
             headers=response.headers
         )
 
+    def _send(self, method: str, full_url: str, **kwargs) -> requests.Response:
+        """Send the request through the upstream circuit breaker, idempotent requests are retried."""
+        breaker = CircuitBreaker().breaker(full_url)
+        retries = self._retry.retries if method in self.IDEMPOTENT_METHODS else 0
+        for attempt in range(retries + 1):
+            if not breaker.allow():
+                raise CircuitOpenError(f"Circuit open for upstream of '{full_url}'")
+            try:
+                response = self._attempt(method, full_url, **kwargs)
+            except requests.exceptions.RequestException:
+                breaker.failure()
+                if attempt >= retries:
+                    raise
+            except BaseException:
+                # a half-open circuit would wait for its probe forever
+                breaker.failure()
+                raise
+            else:
+                if response.status_code not in self.RETRY_STATUSES:
+                    breaker.success()
+                    return response
+                breaker.failure()
+                if attempt >= retries:
+                    return response
+            # full jitter exponential backoff
+            delay = random.uniform(0, self._retry.backoff * 2 ** attempt)
+            log(f"Request failed '{full_url}', retry {attempt + 1}/{retries} in {delay:.2f}s.")
+            time.sleep(delay)
+        return None
+
+    def _attempt(self, method: str, full_url: str, **kwargs) -> requests.Response:
+        """Send the request within the upstream rate limit, throttled requests are retried."""
+        bucket = RateLimiter().bucket(full_url)
+        archive = TrafficArchive()
+        for attempt in range(self._retry.throttle_retries + 1):
+            bucket.acquire()
+            if archive.replaying:
+                response = archive.replay(method, full_url, kwargs)
+            else:
+                response = SessionPool().session(url=full_url, pool_size=self._pool_size).request(
+                    method=method,
+                    url=full_url,
+                    timeout=int(os.environ.get('REQUEST_TIMEOUT', '15')),
+                    **kwargs
+                )
+            if archive.recording:
+                archive.record(method, full_url, kwargs, response)
+            if response.status_code != 429:
+                bucket.recover()
+                break
+            bucket.throttle(retry_after=retry_after(response.headers))
+            if attempt < self._retry.throttle_retries:
+                log(f"Request throttled '{full_url}', retry {attempt + 1}/{self._retry.throttle_retries}.")
+        return response
+
+    def limit_rate(self, count: float, window: float, burst: int = 1) -> None:
+        """Set the rate limit shared by every handler of the upstream."""
+        RateLimiter().configure(url=self._url, count=count, window=window, burst=burst)
+
     @property
     def params(self) -> dict:
         return self._params
@@ -118,11 +238,11 @@ class RequestHandler:
 
     @property
     def rate_limit(self) -> float:
-        return self._rate_limiter.min_interval
+        return RateLimiter().bucket(self._url).interval
 
     @rate_limit.setter
     def rate_limit(self, value: float) -> None:
-        self._rate_limiter.min_interval = max(value, 0)
+        self.limit_rate(count=1, window=max(value, 0))
 
     @property
     def cache_time(self) -> int:
@@ -132,6 +252,24 @@ class RequestHandler:
     def cache_time(self, value: int) -> None:
         self._cache_handler.cache_time = max(value, 0)
 
+    @property
+    def cache_policy(self) -> str:
+        return self._cache_handler.policy
+
+    @cache_policy.setter
+    def cache_policy(self, value: str) -> None:
+        if value not in CacheHandler.POLICIES:
+            raise ValueError(f"Cache policy must be one of {', '.join(CacheHandler.POLICIES)}.")
+        self._cache_handler.policy = value
+
+    @property
+    def stale_time(self) -> Optional[int]:
+        return self._cache_handler.stale_time
+
+    @stale_time.setter
+    def stale_time(self, value: Optional[int]) -> None:
+        self._cache_handler.stale_time = None if value is None else max(int(value), 0)
+
     @property
     def ok_statuses(self) -> set:
         return self._ok_statuses
@@ -148,9 +286,12 @@ class RequestHandler:
 
 class CacheHandler:
     """Handles caching of request responses."""
+    POLICIES = ('ttl', 'stale-while-revalidate', 'refresh-ahead')
 
-    def __init__(self, cache_time: int = 0, db: Optional[Db] = None):
+    def __init__(self, cache_time: int = 0, db: Optional[Db] = None, policy: str = 'ttl', stale_time: int = None):
         self.cache_time = cache_time
+        self.policy = policy
+        self.stale_time = stale_time
         self._db = db or Db()
 
     def _hash(self, method: str, url: str, kwargs: dict) -> str:
@@ -164,28 +305,137 @@ class CacheHandler:
         rhash = self._hash(method, url, kwargs)
         return self._db.get_request(rhash=rhash, expire=self.cache_time)
 
-    def write(self, method: str, url: str, resp_data: dict, **kwargs) -> None:
-        """Write response to the cache."""
+    def lookup(self, method: str, url: str, **kwargs) -> Optional[CachedRequest]:
+        """Return the cached entry if it is fresh or can be revalidated."""
+        if self.cache_time <= 0:
+            return None
+        entry = self._db.get_request_entry(rhash=self._hash(method, url, kwargs), expire=self.cache_time)
+        if not entry or (not self.is_fresh(entry) and not entry.validators and not self.is_servable(entry)):
+            return None
+        return entry
+
+    @property
+    def serve_stale(self) -> bool:
+        """Expired entries are served while they are refreshed in the background."""
+        return self.policy in ('stale-while-revalidate', 'refresh-ahead')
+
+    @property
+    def max_stale(self) -> int:
+        """Seconds an expired entry is still served, one more cache time unless a stale time is set."""
+        return self.cache_time if self.stale_time is None else self.stale_time
+
+    def is_servable(self, entry: CachedRequest) -> bool:
+        """Check the expired entry may be served while it is refreshed, older entries are a cache miss."""
+        return self.serve_stale and entry.added + self.cache_time + self.max_stale >= dt.now().timestamp()
+
+    def track(self, method: str, url: str, refresh: Callable, **kwargs) -> None:
+        """Register the request to be refreshed by the database worker before it expires."""
+        if self.cache_time <= 0 or self.policy != 'refresh-ahead':
+            return
+        self._db.register_refresh(rhash=self._hash(method, url, kwargs), expire=self.cache_time, func=refresh)
+
+    def refresh(self, method: str, url: str, func: Callable, **kwargs) -> None:
+        """Refresh the entry in the background."""
+        self._db.refresh(rhash=self._hash(method, url, kwargs), func=func)
+
+    def is_fresh(self, entry: CachedRequest) -> bool:
+        """Check the entry is within the cache time."""
+        return entry.added + self.cache_time >= dt.now().timestamp()
+
+    def write(self, method: str, url: str, resp_data: dict, validators: dict = None, **kwargs) -> None:
+        """Write response and its ETag and Last-Modified validators to the cache."""
         if self.cache_time <= 0:
             return
         rhash = self._hash(method, url, kwargs)
-        self._db.store_request(rhash=rhash, data=resp_data)
-
-
-class RateLimiter:  # pylint: disable=too-few-public-methods
-    """Simple rate limiter that ensures a minimum delay between actions."""
-
-    def __init__(self, min_interval: float = 0.3):
-        self.min_interval = max(float(os.environ.get('REQUEST_MIN_INTERVAL', min_interval)), 0)
-        self._last_time = None
-
-    def wait(self) -> None:
-        """Wait if needed to enforce rate limit."""
-        now = time.time()
-        if self._last_time is not None:
-            elapsed = now - self._last_time
-            if elapsed < self.min_interval:
-                wait_time = self.min_interval - elapsed
-                log(f"Waiting {wait_time:.2f}s to respect rate limit.")
-                time.sleep(wait_time)
-        self._last_time = time.time()
+        validators = validators or {}
+        self._db.store_request(
+            rhash=rhash,
+            data=resp_data,
+            etag=validators.get('ETag'),
+            modified=validators.get('Last-Modified'),
+            expire=self.cache_time,
+        )
+
+    def revalidated(self, method: str, url: str, entry: CachedRequest = None, **kwargs) -> None:
+        """Restart the cache time of an entry the upstream reported as not modified."""
+        self._db.touch_request(rhash=self._hash(method, url, kwargs), entry=entry, expire=self.cache_time)
+
+
+@dataclass
+class FlightCall:
+    """Upstream call shared by identical requests, set with its result or error when it is done."""
+    done: threading.Event = field(default_factory=threading.Event)
+    result: Any = None
+    error: Optional[BaseException] = None
+
+
+class SingleFlight(metaclass=SingletonMeta):
+    """Coalesce identical requests in flight at the same time into one upstream call."""
+    METHODS = ('GET', 'HEAD')
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._executed = 0
+        self._coalesced = 0
+
+    @staticmethod
+    def key(method: str, url: str, kwargs: dict) -> str:
+        """Return the key of a request from its method, url and canonical arguments."""
+        canonical = json.dumps(kwargs, sort_keys=True, default=str)
+        return hashlib.md5(f"{method}:{url}:{canonical}".encode()).hexdigest()
+
+    def do(self, key: str, func: Callable[[], Any]) -> Any:
+        """Run the function unless a call with the same key is in flight, then wait for its result."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = FlightCall()
+                self._executed += 1
+            else:
+                self._coalesced += 1
+        if not leader:
+            log(f"Request '{key}' already in flight, waiting for its result.")
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result
+
+    def stats(self) -> dict:
+        """Return the number of executed and coalesced calls."""
+        with self._lock:
+            return {
+                'executed': self._executed,
+                'coalesced': self._coalesced,
+                'in_flight': len(self._calls),
+            }
+
+    def close(self) -> None:
+        """Log how many calls were executed and coalesced."""
+        log(f"Single flight stats: {self.stats()}")
+
+
+def retry_after(headers: dict) -> Optional[float]:
+    """Return the seconds to wait from a Retry-After header given as seconds or HTTP date."""
+    value = (headers or {}).get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - dt.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
@@ -1,42 +1,58 @@
 """Flow Runner"""
 
 import os
-from typing import Any
+import copy
+import random
+import hashlib
+import threading
+from typing import Any, Optional
+from dataclasses import dataclass, field
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import inspect
 import yaml
 from cineflow.bases.module import ModuleBase
 from cineflow.bases.worker import WorkerBase
+from cineflow.system.scheduler import CronTrigger
 from cineflow.system.logger import log
-from cineflow.system.misc import load_module
+from cineflow.system.instances import ModulePool
+from cineflow.system.watcher import DirectoryWatcher
+from cineflow.system.stream import Stream, StreamOptions, chunked
 
 
 class FlowManager(WorkerBase):
     """Flow Runner class to manage the execution of tasks."""
+    HOUSEKEEPING = True
 
     def __init__(self) -> None:
         """Initialize the task runner."""
         super().__init__()
         self._dir = os.environ.get("CFG_DIRECTORY", "/config")
         self._flows = {}
+        self._watcher = DirectoryWatcher(directory=self._dir, callback=lambda: self.reschedule(run_now=True))
         if os.path.exists(self._dir):
+            self._watcher.start()
             self.start()
 
     def run(self) -> None:
         """Run the flow manager."""
         files = []
         for file in os.listdir(self._dir):
-            if os.path.isdir(file) or file == "config.yaml":
+            if os.path.isdir(os.path.join(self._dir, file)) or file == "config.yaml":
                 continue
             if file.endswith('.yaml') or file.endswith('.yml'):
                 files.append(os.path.join(self._dir, file))
-            log(f"Skipping non-YAML file: {file}")
-        if not files:
+            else:
+                log(f"Skipping non-YAML file: {file}")
+        if not files and not self._flows:
             log("No flow files found to run.", level="INFO")
             return
-        # add new flows
+        # add new flows, reload the changed ones
         for file in files:
             if file not in self._flows:
                 self._flows[file] = Flow(file)
+            else:
+                self._flows[file].load()
         # remove deleted flows
         keys_to_remove = []
         for key, flow in self._flows.items():
@@ -45,72 +61,226 @@ class FlowManager(WorkerBase):
                 keys_to_remove.append(key)
         for key in keys_to_remove:
             flow = self._flows.pop(key)
-            del flow
+            flow.stop()
 
     def close(self) -> None:
         """Close the flow manager."""
+        self._watcher.stop()
         for flow in self._flows.values():
             log(f"Stopping flow '{flow.name}'.", level="INFO")
             flow.stop()
 
 
+@dataclass
+class FlowFile:
+    """Path of a flow file with the fingerprint, digest and validity of its last load."""
+    path: str
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    fingerprint: Optional[tuple] = None
+    digest: Optional[str] = None
+    valid: bool = False
+
+    @property
+    def name(self) -> str:
+        """Get the file name without the directory."""
+        return os.path.basename(self.path)
+
+
 class Flow(WorkerBase):  # pylint: disable=too-few-public-methods
     """Class to manage the execution of a flow."""
 
     def __init__(self, file: str) -> None:
         """Initialize the task runner."""
         super().__init__()
-        self._file = file
-        self._filename = os.path.basename(file)
+        self._file = FlowFile(path=file)
         self.name = 'Unnamed Flow'
         self.steps = []
         self.delay = 60
-        self._mod_cache = {}
-        self._outputs = {}
-        log(f"Flow '{self._filename}' initialized.", level="INFO")
+        self._first_delay = random.randint(1, 10)
+        self._plan = ([], [], [])
+        log(f"Flow '{self._file.name}' initialized.", level="INFO")
         self.start()
 
     def run(self) -> None:
         """Run the flow."""
         super().run()
-        if not self._validate_flow():
+        if not self._running or not self.load():
             return
-        log(f"Flow '{self.name}' from file '{self._filename}' started.", level="INFO")
-        for step in self.steps:
-            log(f"Start step '{step.get('name')}'", level="MSG")
-            outp = None
-            try:
-                if not (inst := self._load_module(step=step)):
-                    return
-                if not (action := self._load_action(inst=inst, step=step)):
-                    return
-                if not (inp := self._load_input(step=step)):
-                    log(f"No input data for step '{step.get('name')}'.")
-                outp = self._call_action(action=action, inp=inp)
-            except (ValueError, TypeError) as exc:
-                log(f"Stop flow, error calling action '{step}': {exc}", level="ERROR")
-                # log (f"Parameters: {inp}")
+        log(f"Flow '{self.name}' from file '{self._file.name}' started.", level="INFO")
+        outputs = {}
+        try:
+            if not self._run_steps(outputs=outputs):
+                log(f"Flow '{self.name}' finished with failed steps.", level="ERROR")
                 return
-            # if outp:
-            if step.get("name"):
-                self._outputs[step.get("name")] = outp
-            self._outputs['latest'] = outp
-            log(f"Step '{step.get('name')}' executed successfully.", level="MSG")
+            # streaming steps nobody consumed still have to finish their work
+            for outp in self._streams(outputs=outputs):
+                outp.drain()
+        except ValueError as exc:
+            log(f"Stop flow '{self.name}', {exc}", level="ERROR")
+            return
+        finally:
+            for outp in self._streams(outputs=outputs):
+                outp.close()
         log(f"Flow '{self.name}' executed successfully.", level="INFO")
 
+    def _run_steps(self, outputs: dict) -> bool:
+        """Run each step once the steps it depends on finished, return False when a step failed."""
+        steps, depends, sources = self._plan
+        pending, done, failed = set(range(len(steps))), set(), set()
+        futures = {}
+        workers = max(int(os.environ.get('FLOW_WORKERS', '4')), 1)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="step") as executor:
+            while pending or futures:
+                for index in self._ready(pending=pending, depends=depends, done=done, failed=failed, steps=steps):
+                    future = executor.submit(self._run_step, step=steps[index], source=sources[index], outputs=outputs)
+                    futures[future] = index
+                if not futures:
+                    break
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    index = futures.pop(future)
+                    success, outputs[index] = future.result()
+                    (done if success else failed).add(index)
+        return not failed
+
+    @staticmethod
+    def _ready(pending: set, depends: list, done: set, failed: set, steps: list) -> list:
+        """Take the pending steps whose dependencies finished, the dependents of failed steps are skipped."""
+        ready = []
+        for index in sorted(pending):
+            if depends[index] & failed:
+                log(f"Step '{steps[index].get('name')}' skipped, a step it depends on failed.", level="WARNING")
+                failed.add(index)
+            elif depends[index] <= done:
+                ready.append(index)
+            else:
+                continue
+            pending.discard(index)
+        return ready
+
+    def _run_step(self, step: dict, source: int | None, outputs: dict) -> tuple:
+        """Run a single step, return whether it succeeded and its output."""
+        log(f"Start step '{step.get('name')}'", level="MSG")
+        outp = None
+        try:
+            if not (inst := self._load_module(step=step)):
+                return False, None
+            if not (action := self._load_action(inst=inst, step=step)):
+                return False, None
+            if not (inp := self._load_input(step=step, source=source, outputs=outputs)):
+                log(f"No input data for step '{step.get('name')}'.")
+            if self._streamed(step=step, action=action):
+                outp = self._stream_action(action=action, inp=inp, step=step)
+            else:
+                outp = self._call_action(action=action, inp=self._materialize(inp=inp))
+        except (ValueError, TypeError) as exc:
+            log(f"Step failed, error calling action '{step}': {exc}", level="ERROR")
+            # log (f"Parameters: {inp}")
+            return False, None
+        state = 'streaming' if isinstance(outp, Stream) else 'executed successfully'
+        log(f"Step '{step.get('name')}' {state}.", level="MSG")
+        return True, outp
+
+    @staticmethod
+    def _streams(outputs: dict) -> list:
+        """Return the streams of the steps in the order they were produced."""
+        streams = []
+        for outp in outputs.values():
+            if isinstance(outp, Stream) and outp not in streams:
+                streams.append(outp)
+        return streams
+
+    @staticmethod
+    def _streamed(step: dict, action: callable) -> bool:
+        """Return whether the step streams, actions which need the full set always materialize."""
+        if not step.get("stream"):
+            return False
+        if getattr(action, 'materialized', False):
+            log(f"Action '{step.get('action')}' needs all items, step '{step.get('name')}' is not streamed.")
+            return False
+        return True
+
+    def _stream_action(self, action: callable, inp: Any, step: dict) -> Stream:
+        """Call the action for each chunk of the input in a producer thread."""
+        size = max(int(step.get("chunk", 10)), 1)
+        data = inp.get("data") if isinstance(inp, dict) else inp
+        upstream = data if isinstance(data, Stream) else None
+        if upstream or isinstance(data, list):
+            chunks = chunked(upstream.flatten() if upstream else data, size=size)
+            source = ({**inp, "data": chunk} if isinstance(inp, dict) else chunk for chunk in chunks)
+        else:
+            # an action without item input is called once, its result is streamed
+            source = [inp]
+        return Stream(
+            name=step.get("name") or step.get("action"),
+            source=source,
+            func=lambda arg: self._stream_items(self._call_action(action=action, inp=arg)),
+            options=StreamOptions(chunk=size, buffer=step.get("buffer", 2), upstream=upstream),
+        )
+
+    @staticmethod
+    def _stream_items(outp: Any) -> Any:
+        """Return the output of an action call as the items to stream."""
+        if outp is None:
+            return []
+        return [outp] if isinstance(outp, Mapping) else outp
+
+    @staticmethod
+    def _materialize(inp: Any) -> Any:
+        """Collect the streamed input of a step which is not streamed."""
+        if isinstance(inp, Stream):
+            return inp.materialize()
+        if isinstance(inp, dict) and isinstance(inp.get("data"), Stream):
+            return {**inp, "data": inp["data"].materialize()}
+        return inp
+
     def _load_module(self, step: dict) -> ModuleBase | None:
-        """Load a module by its name."""
+        """Load a module by its name, instances are shared by the steps and flows with the same config."""
         name = step.get('module')
-        if name in self._mod_cache:
-            mod = self._mod_cache[name]
-        else:
-            mod = load_module(name)
-        if not mod:
+        if not (inst := ModulePool().get(name=name, config=step.get("config"))):
             log(f"Module '{name}' not found, stop flow.", level="ERROR")
             return None
-        if name not in self._mod_cache:
-            self._mod_cache[name] = mod
-        return mod(config=step.get("config"))
+        return inst
+
+    def load(self) -> bool:
+        """Parse and validate the flow file when it changed since the last load, return the validity."""
+        with self._file.lock:
+            try:
+                stat = os.stat(self._file.path)
+                if (fingerprint := (stat.st_mtime_ns, stat.st_size)) == self._file.fingerprint:
+                    return self._file.valid
+                with open(self._file.path, 'rb') as stream:
+                    content = stream.read()
+            except OSError as exc:
+                log(f"Error reading flow file '{self._file.name}': {exc}", level="WARNING")
+                return False
+            self._file.fingerprint = fingerprint
+            # a touched file with the same content is not parsed again
+            if (digest := hashlib.sha256(content).hexdigest()) == self._file.digest:
+                return self._file.valid
+            loaded, self._file.digest = self._file.digest, digest
+            schedule = (self.delay, self._cron)
+            parallel = self._parse_file(content=content)
+            self._file.valid = self._validate_flow() and self._plan_steps(parallel=parallel)
+            log(f"Flow '{self.name}' loaded from file '{self._file.name}'.")
+        changed = (self.delay, self._cron) != schedule
+        if changed or not loaded:
+            ModulePool().expect(name=self.job_name, interval=self._trigger().interval())
+        if changed:
+            if loaded:
+                log(f"Flow '{self.name}' schedule changed to {self._trigger()}, rescheduled.", level="INFO")
+            self.reschedule()
+        return self._file.valid
+
+    def stop(self) -> None:
+        """Stop the flow, its modules are no longer expected by the pool."""
+        super().stop()
+        ModulePool().expect(name=self.job_name, interval=None)
+
+    @property
+    def job_name(self) -> str:
+        """Get the name of the scheduled job."""
+        return f"flow:{self._file.path}"
 
     def _load_action(self, inst: ModuleBase, step: dict) -> callable:
         """Load an action function from the module."""
@@ -123,21 +293,85 @@ class Flow(WorkerBase):  # pylint: disable=too-few-public-methods
             return None
         return action
 
-    def _load_input(self, step: dict) -> dict:
-        """Load input data for the action."""
+    def _plan_steps(self, parallel: bool) -> bool:
+        """Plan the order of the steps, return False when the steps cannot run together."""
+        try:
+            self._plan = self._build_plan(steps=list(self.steps), parallel=parallel)
+        except ValueError as exc:
+            log(f"Invalid flow file '{self._file.name}': {exc}", level="WARNING")
+            return False
+        return True
+
+    def _build_plan(self, steps: list, parallel: bool = True) -> tuple:
+        """Return the steps with the indexes they depend on and the index their input data comes from."""
+        depends, sources, afters, names = [], [], [], {}
+        sequential = not parallel
+        for index, step in enumerate(steps):
+            source = self._input_source(step=step, index=index, names=names)
+            after = step.get("after") or []
+            required = {names[name] for name in ([after] if isinstance(after, str) else after) if name in names}
+            afters.append(set(required))
+            if source is not None:
+                required.add(source)
+            if sequential and index:
+                required.add(index - 1)
+            depends.append(required)
+            sources.append(source)
+            if step.get("name"):
+                names[step.get("name")] = index
+        self._check_streams(steps=steps, afters=afters, sources=sources)
+        return steps, depends, sources
+
+    @staticmethod
+    def _check_streams(steps: list, afters: list, sources: list) -> None:
+        """Raise a ValueError when a streaming step has more than one consumer or other steps run after it."""
+        consumers = {}
+        for index, step in enumerate(steps):
+            name = step.get("name") or index
+            # a streaming step is done when it starts, its items are produced while the consumer reads them
+            for required in afters[index] - {sources[index]}:
+                if steps[required].get("stream"):
+                    raise ValueError(f"Step '{name}' cannot run after streaming step '{steps[required].get('name')}'.")
+            if (source := sources[index]) is not None and steps[source].get("stream"):
+                if source in consumers:
+                    raise ValueError(
+                        f"Output of streaming step '{steps[source].get('name')}' is read by "
+                        f"steps '{consumers[source]}' and '{name}', only one step can consume a stream."
+                    )
+                consumers[source] = name
+
+    def _input_source(self, step: dict, index: int, names: dict) -> int | None:
+        """Return the index of the earlier step the input data of the step refers to."""
+        inp = step.get("input")
+        data = inp.get("data") if isinstance(inp, dict) else inp
+        if data == "previous":
+            return index - 1 if index else None
+        if (reference := self._reference(data)) is None:
+            return None
+        if reference not in names:
+            log(f"Step '{step.get('name')}' refers to unknown step '{reference}'.", level="WARNING")
+            return None
+        return names[reference]
+
+    @staticmethod
+    def _reference(value: Any) -> str | None:
+        """Return the step name of a '{{name}}' reference."""
+        if isinstance(value, str) and value.startswith("{{") and value.endswith("}}"):
+            return value.strip("{}")
+        return None
+
+    @staticmethod
+    def _load_input(step: dict, source: int | None, outputs: dict) -> dict:
+        """Load input data for the action, actions get a copy so the step definition is kept for the next runs."""
         inp = step.get("input")
         if not inp or inp == "none":
             return None
-        if inp == "previous":
-            return self._outputs.get('latest')
-        if isinstance(inp, str):
-            if str(inp).startswith("{{") and str(inp).endswith("}}"):
-                if str(inp).strip("{}") in self._outputs:
-                    return self._outputs[str(inp).strip("{}")]
+        if source is None:
+            return copy.deepcopy(inp)
         if isinstance(inp, dict):
-            if inp.get("data") and inp.get("data") == "previous":
-                inp["data"] = self._outputs.get('latest')
-        return inp
+            params = copy.deepcopy({key: value for key, value in inp.items() if key != "data"})
+            return {**params, "data": outputs.get(source)}
+        return outputs.get(source)
 
     def _call_action(self, action: callable, inp: dict) -> Any:
         """Call the action with the provided input data."""
@@ -153,21 +387,23 @@ class Flow(WorkerBase):  # pylint: disable=too-few-public-methods
             return action(inp)
         return action(**inp)
 
-    def _parse_file(self) -> None:
-        with open(self._file, 'r', encoding='UTF-8') as stream:
-            try:
-                data = yaml.safe_load(stream)
-                if data and isinstance(data, dict) and data.get("steps"):
-                    self.name = data.get("name", self.name)
-                    self.steps = data.get("steps", self.steps)
-                    self.delay = data.get("delay", self.delay)
-            except yaml.YAMLError as exc:
-                log(f"Error loading flow file '{self._filename}': {exc}", level="WARNING")
+    def _parse_file(self, content: bytes) -> bool:
+        """Read the flow definition, return whether independent steps run in parallel."""
+        try:
+            data = yaml.safe_load(content.decode('UTF-8'))
+            if data and isinstance(data, dict) and data.get("steps"):
+                self.name = data.get("name", self.name)
+                self.steps = data.get("steps", self.steps)
+                self.delay = data.get("delay", self.delay)
+                self._cron = CronTrigger(data["cron"]).expression if data.get("cron") else None
+                return data.get("parallel", True) is not False
+        except (yaml.YAMLError, UnicodeDecodeError, ValueError) as exc:
+            log(f"Error loading flow file '{self._file.name}': {exc}", level="WARNING")
+        return True
 
     def _validate_flow(self) -> bool:
-        self._parse_file()
         if not isinstance(self.steps, list) or not self.steps:
-            log(f"Flow steps are missing or invalid in '{self._filename}'.", level="WARNING")
+            log(f"Flow steps are missing or invalid in '{self._file.name}'.", level="WARNING")
             return False
         for step in self.steps:
             if not isinstance(step, dict):
@@ -0,0 +1,282 @@
+"""This module provides the scheduler which runs every periodic job of the application."""
+
+import os
+import time
+import heapq
+import random
+import itertools
+import threading
+from typing import Callable, Optional
+from dataclasses import dataclass, field
+from datetime import datetime as dt, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from cineflow.system.logger import log
+from cineflow.bases.singleton import SingletonMeta
+
+
+class IntervalTrigger:
+    """Trigger a job a fixed number of seconds after its previous run finished."""
+
+    def __init__(self, seconds: float) -> None:
+        self.seconds = max(float(seconds), 1.0)
+
+    def next(self, after: float) -> float:
+        """Return the time of the next run after the given time."""
+        return after + self.seconds
+
+    def interval(self) -> float:
+        """Return the longest time between two runs."""
+        return self.seconds
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, IntervalTrigger) and other.seconds == self.seconds
+
+    def __repr__(self) -> str:
+        return f"every {self.seconds:.0f}s"
+
+
+class CronTrigger:
+    """Trigger a job on the minutes matching a five field cron expression."""
+    FIELDS = (('minute', 0, 59), ('hour', 0, 23), ('day', 1, 31), ('month', 1, 12), ('weekday', 0, 6))
+
+    def __init__(self, expression: str) -> None:
+        self.expression = ' '.join(str(expression or '').split())
+        parts = self.expression.split(' ')
+        if len(parts) != len(self.FIELDS):
+            raise ValueError(f"Cron expression '{expression}' must have {len(self.FIELDS)} fields.")
+        values = {}
+        for part, (name, low, high) in zip(parts, self.FIELDS):
+            values[name] = self._parse(part, low, high)
+        self._minutes, self._hours = values['minute'], values['hour']
+        self._days, self._months, self._weekdays = values['day'], values['month'], values['weekday']
+        # like cron a restricted day of month or weekday matches when any of them match
+        self._any_day = parts[2] != '*' and parts[4] != '*'
+
+    def next(self, after: float) -> float:
+        """Return the time of the next matching minute after the given time."""
+        moment = dt.fromtimestamp(after).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 4)
+        while moment < limit:
+            if moment.month not in self._months:
+                moment = (moment.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self._hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self._minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment.timestamp()
+        raise ValueError(f"Cron expression '{self.expression}' never matches.")
+
+    def interval(self, runs: int = 8) -> float:
+        """Return the longest time between the next runs, a week of daily runs also covers the weekend gaps."""
+        times = [self.next(time.time())]
+        for _ in range(runs):
+            times.append(self.next(times[-1]))
+        return max(later - earlier for earlier, later in zip(times, times[1:]))
+
+    def _day_matches(self, moment: dt) -> bool:
+        day = moment.day in self._days
+        weekday = (moment.weekday() + 1) % 7 in self._weekdays
+        return (day or weekday) if self._any_day else (day and weekday)
+
+    @staticmethod
+    def _parse(part: str, low: int, high: int) -> set:
+        # sunday is 0 and 7
+        weekday = (low, high) == (0, 6)
+        high += weekday
+        values = set()
+        for item in part.split(','):
+            span, _, step = item.partition('/')
+            try:
+                step = int(step) if step else 1
+                if span == '*':
+                    start, end = low, high
+                elif '-' in span:
+                    start, end = (int(value) for value in span.split('-', 1))
+                else:
+                    start = end = int(span)
+            except ValueError as e:
+                raise ValueError(f"Invalid cron field '{part}'.") from e
+            if step < 1 or start < low or end > high or start > end:
+                raise ValueError(f"Cron field '{part}' out of range {low}-{high}.")
+            values.update(range(start, end + 1, step))
+        return {value % 7 for value in values} if weekday else values
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, CronTrigger) and other.expression == self.expression
+
+    def __repr__(self) -> str:
+        return f"cron '{self.expression}'"
+
+
+@dataclass
+class JobState:
+    """Whether a job is registered, runs or has a run pending, its queued due time and when it last finished."""
+    active: bool = True
+    running: bool = False
+    pending: bool = False
+    version: int = 0
+    due: float = 0.0
+    finished: Optional[float] = None
+
+
+@dataclass
+class JobStats:
+    """Runs, failures and overlapping triggers of a job and the duration of its last run."""
+    runs: int = 0
+    failures: int = 0
+    overlaps: int = 0
+    duration: float = 0.0
+    created: float = field(default_factory=time.time)
+
+
+@dataclass
+class Job:
+    """Scheduled job with its trigger, random start delay, worker pool, run state and counters."""
+    name: str
+    func: Callable
+    trigger: IntervalTrigger | CronTrigger
+    jitter: float = 0.0
+    pool: str = 'flow'
+    state: JobState = field(default_factory=JobState)
+    stats: JobStats = field(default_factory=JobStats)
+
+
+class Scheduler(metaclass=SingletonMeta):
+    """Run the registered jobs on bounded pools, a job never runs concurrently with itself."""
+
+    def __init__(self) -> None:
+        self._condition = threading.Condition()
+        self._queue = []
+        self._jobs = {}
+        self._counter = itertools.count()
+        workers = max(int(os.environ.get('SCHEDULER_WORKERS', '4')), 1)
+        housekeeping = max(int(os.environ.get('SCHEDULER_HOUSEKEEPING_WORKERS', '2')), 1)
+        # long flows cannot hold up the cache maintenance, the directory scans and the flow reloads
+        self._executors = {
+            'flow': ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job"),
+            'housekeeping': ThreadPoolExecutor(max_workers=housekeeping, thread_name_prefix="housekeeping"),
+        }
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, daemon=True, name="scheduler")
+        self._thread.start()
+        log(f"Scheduler started with {workers} flow and {housekeeping} housekeeping workers.")
+
+    def add(self, job: Job, first_delay: float = 0.0) -> Job:
+        """Register a job, a job registered with the same name is replaced."""
+        if job.pool not in self._executors:
+            raise ValueError(f"Unknown worker pool '{job.pool}' of job '{job.name}'.")
+        with self._condition:
+            if previous := self._jobs.get(job.name):
+                previous.state.active = False
+                log(f"Job '{job.name}' replaced.")
+            self._jobs[job.name] = job
+            if isinstance(job.trigger, IntervalTrigger):
+                due = time.time() + first_delay
+            else:
+                due = job.trigger.next(time.time())
+            self._push(job=job, due=due)
+        log(f"Job '{job.name}' scheduled {job.trigger} on the {job.pool} workers.")
+        return job
+
+    def remove(self, job: Job) -> None:
+        """Unregister the job, a running job finishes its current run."""
+        with self._condition:
+            job.state.active = False
+            if self._jobs.get(job.name) is job:
+                del self._jobs[job.name]
+            self._condition.notify()
+
+    def reschedule(self, job: Job, trigger: IntervalTrigger | CronTrigger = None, run_now: bool = False) -> None:
+        """Calculate the next run with the trigger, or run the job at once."""
+        with self._condition:
+            if not job.state.active:
+                return
+            job.trigger = trigger or job.trigger
+            if job.state.running:
+                # the next run is calculated when the current one finishes
+                job.state.pending = job.state.pending or run_now
+                return
+            if run_now:
+                due = time.time()
+            elif job.state.finished is None and isinstance(job.trigger, IntervalTrigger):
+                due = job.state.due
+            else:
+                due = job.trigger.next(job.state.finished or time.time())
+            self._push(job=job, due=due)
+
+    def stats(self) -> dict:
+        """Return the state and counters of every job."""
+        with self._condition:
+            return {
+                name: {
+                    'trigger': repr(job.trigger),
+                    'pool': job.pool,
+                    'running': job.state.running,
+                    'next': round(max(job.state.due - time.time(), 0), 1),
+                    'runs': job.stats.runs,
+                    'failures': job.stats.failures,
+                    'overlaps': job.stats.overlaps,
+                    'duration': round(job.stats.duration, 2),
+                }
+                for name, job in self._jobs.items()
+            }
+
+    def close(self) -> None:
+        """Stop the scheduler, running jobs are not waited for."""
+        log(f"Scheduler stats: {self.stats()}")
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join(timeout=5)
+        for executor in self._executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        log("Scheduler stopped.")
+
+    def _push(self, job: Job, due: float) -> None:
+        """Queue the next run of the job, earlier queued runs of it are dropped."""
+        job.state.version += 1
+        job.state.due = due + random.uniform(0, job.jitter)
+        heapq.heappush(self._queue, (job.state.due, next(self._counter), job.state.version, job))
+        self._condition.notify()
+
+    def _loop(self) -> None:
+        with self._condition:
+            while self._running:
+                if not self._queue:
+                    self._condition.wait()
+                    continue
+                due, _, version, job = self._queue[0]
+                if (wait := due - time.time()) > 0:
+                    self._condition.wait(timeout=wait)
+                    continue
+                heapq.heappop(self._queue)
+                if not job.state.active or version != job.state.version:
+                    continue
+                if job.state.running:
+                    job.stats.overlaps += 1
+                    job.state.pending = True
+                    continue
+                job.state.running = True
+                self._executors[job.pool].submit(self._execute, job)
+
+    def _execute(self, job: Job) -> None:
+        started = time.time()
+        failed = False
+        try:
+            job.func()
+        except Exception as e:  # pylint: disable=broad-except
+            failed = True
+            log(f"Job '{job.name}' failed: {e}", level='ERROR')
+        with self._condition:
+            job.state.finished = time.time()
+            job.stats.duration = job.state.finished - started
+            job.stats.runs += 1
+            job.stats.failures += failed
+            job.state.running = False
+            if job.state.active:
+                due = job.state.finished if job.state.pending else job.trigger.next(job.state.finished)
+                job.state.pending = False
+                self._push(job=job, due=due)
@@ -0,0 +1,117 @@
+"""This module provides the item streams passed between streaming flow steps."""
+
+import time
+import queue
+import threading
+from typing import Callable, Iterable, Iterator, List, Optional
+from dataclasses import dataclass
+from cineflow.system.logger import log
+
+END = object()
+
+
+def chunked(items: Iterable, size: int) -> Iterator[List]:
+    """Yield the items in lists of the given size, the last one can be shorter."""
+    chunk = []
+    for item in items or []:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+@dataclass
+class StreamOptions:
+    """Chunk size and buffered chunks of a stream and the stream it reads from."""
+    chunk: int = 10
+    buffer: int = 2
+    upstream: Optional['Stream'] = None
+
+
+class Stream:
+    """Chunks of items produced by a step in its own thread, consumed once by the next step."""
+
+    def __init__(self, name: str, source: Iterable, func: Callable, options: StreamOptions = None) -> None:
+        self.name = name
+        self._options = options or StreamOptions()
+        # a full buffer blocks the producer until the next step takes a chunk
+        self._queue = queue.Queue(maxsize=max(int(self._options.buffer), 1))
+        self._cancelled = threading.Event()
+        self._consumed = False
+        self._error = None
+        self._thread = threading.Thread(target=self._produce, args=(source, func), daemon=True, name=f"stream:{name}")
+        self._thread.start()
+
+    def __iter__(self) -> Iterator[List]:
+        """Yield the produced chunks."""
+        if self._consumed:
+            raise ValueError(f"Output of streaming step '{self.name}' was already consumed.")
+        self._consumed = True
+        while (chunk := self._get()) is not END:
+            yield chunk
+        if self._error:
+            raise ValueError(f"Streaming step '{self.name}' failed: {self._error}") from self._error
+
+    def flatten(self) -> Iterator:
+        """Yield the produced items one by one."""
+        for chunk in self:
+            yield from chunk
+
+    def materialize(self) -> List:
+        """Return all produced items, for the steps which need the full set."""
+        items = list(self.flatten())
+        log(f"Output of streaming step '{self.name}' materialized with {len(items)} items.")
+        return items
+
+    def drain(self) -> None:
+        """Consume the remaining chunks so the step and its upstream steps finish."""
+        if not self._consumed:
+            for _ in self:
+                pass
+
+    def close(self) -> None:
+        """Stop producing, the upstream streams are closed too."""
+        self._cancelled.set()
+        if self._options.upstream:
+            self._options.upstream.close()
+
+    def _produce(self, source: Iterable, func: Callable) -> None:
+        started = time.monotonic()
+        items = chunks = 0
+        try:
+            for chunk in source:
+                for produced in chunked(func(chunk), size=max(int(self._options.chunk), 1)):
+                    if not self._put(produced):
+                        return
+                    items += len(produced)
+                    chunks += 1
+        except Exception as e:  # pylint: disable=broad-except
+            self._error = e
+            log(f"Streaming step '{self.name}' failed: {e}", level='ERROR')
+        log(
+            f"Streaming step '{self.name}' produced {items} items in {chunks} chunks "
+            f"in {time.monotonic() - started:.1f}s."
+        )
+        self._put(END)
+
+    def _get(self) -> object:
+        """Wait for the next chunk, END when the stream was closed."""
+        while True:
+            try:
+                return self._queue.get(timeout=0.5)
+            except queue.Empty:
+                # a closed producer puts no END, the consumer stops by itself
+                if self._cancelled.is_set():
+                    return END
+
+    def _put(self, chunk: object) -> bool:
+        """Wait for room in the buffer, return False when the stream was closed."""
+        while not self._cancelled.is_set():
+            try:
+                self._queue.put(chunk, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
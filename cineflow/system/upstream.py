@@ -0,0 +1,351 @@
+"""This module provides process wide state shared per upstream host."""
+
+import os
+import time
+import threading
+from typing import Optional
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from cineflow.system.logger import log
+from cineflow.system.misc import pop_idle
+from cineflow.bases.singleton import SingletonMeta
+
+
+def upstream_key(url: str) -> str:
+    """Return the scheme and host part of the url used to key upstream state."""
+    parts = urlsplit(url or '')
+    return f"{parts.scheme}://{parts.netloc}".lower()
+
+
+@dataclass
+class PooledSession:
+    """Keep-alive session of an upstream host, its connection pool size and when it was created and last used."""
+    session: requests.Session
+    pool_size: int
+    created: float = field(default_factory=time.monotonic)
+    last_used: float = field(default_factory=time.monotonic)
+    requests: int = 0
+
+
+class SessionPool(metaclass=SingletonMeta):
+    """Registry of keep-alive HTTP sessions shared by every request handler."""
+    DEFAULT_POOL_SIZE = 10
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._pool_size = max(int(os.environ.get('REQUEST_POOL_SIZE', self.DEFAULT_POOL_SIZE)), 1)
+        self._idle_timeout = max(int(os.environ.get('REQUEST_POOL_IDLE', '300')), 0)
+        self._evicted = 0
+
+    def session(self, url: str, pool_size: Optional[int] = None) -> requests.Session:
+        """Return the shared session for the upstream of the given url."""
+        key = upstream_key(url)
+        pool_size = max(int(pool_size or self._pool_size), 1)
+        self._evict_idle(keep=key)
+        with self._lock:
+            pooled = self._sessions.get(key)
+            if not pooled:
+                pooled = PooledSession(session=self._new_session(pool_size), pool_size=pool_size)
+                self._sessions[key] = pooled
+                log(f"Session pool created for '{key}' with size {pool_size}.")
+            elif pool_size > pooled.pool_size:
+                # grow the pool when a handler asks for more parallel connections
+                self._mount(pooled.session, pool_size)
+                pooled.pool_size = pool_size
+                log(f"Session pool for '{key}' resized to {pool_size}.")
+            pooled.last_used = time.monotonic()
+            pooled.requests += 1
+            return pooled.session
+
+    def stats(self) -> dict:
+        """Return usage statistics for every pooled upstream."""
+        now = time.monotonic()
+        with self._lock:
+            stats = {
+                key: {
+                    'pool_size': pooled.pool_size,
+                    'requests': pooled.requests,
+                    'connections': self._connections(pooled.session),
+                    'idle': round(now - pooled.last_used, 1),
+                }
+                for key, pooled in self._sessions.items()
+            }
+        return {'upstreams': stats, 'evicted': self._evicted}
+
+    def close(self) -> None:
+        """Close every pooled session."""
+        log(f"Session pool stats: {self.stats()}")
+        with self._lock:
+            for pooled in self._sessions.values():
+                pooled.session.close()
+            self._sessions.clear()
+        log("Session pool closed.")
+
+    def _evict_idle(self, keep: str = None) -> None:
+        """Close sessions which were not used for longer than the idle timeout."""
+        with self._lock:
+            evicted = pop_idle(self._sessions, timeout=self._idle_timeout, keep=keep)
+            self._evicted += len(evicted)
+        for key, pooled in evicted.items():
+            pooled.session.close()
+            log(f"Session pool for '{key}' evicted after being idle.")
+
+    def _new_session(self, pool_size: int) -> requests.Session:
+        session = requests.Session()
+        session.headers.update({'Connection': 'keep-alive'})
+        self._mount(session, pool_size)
+        return session
+
+    @staticmethod
+    def _mount(session: requests.Session, pool_size: int) -> None:
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+    @staticmethod
+    def _connections(session: requests.Session) -> int:
+        """Count the connections opened by the session, reused ones are counted once."""
+        count = 0
+        for adapter in set(session.adapters.values()):
+            try:
+                pools = adapter.poolmanager.pools
+                count += sum(pools[key].num_connections for key in pools.keys())
+            except (AttributeError, KeyError):
+                continue
+        return count
+
+
+@dataclass
+class BucketStats:
+    """Tokens handed out by a bucket, the callers it throttled and the seconds they waited."""
+    acquired: int = 0
+    throttled: int = 0
+    waited: float = 0.0
+
+
+class TokenBucket:
+    """Thread-safe token bucket, callers are served in the order they asked for a token."""
+
+    def __init__(self, count: float, window: float, burst: int = 1) -> None:
+        self._lock = threading.Lock()
+        self._interval = 0.0
+        self._base_interval = 0.0
+        self._tolerance = 0.0
+        self._arrival = 0.0
+        self._strikes = 0
+        self._stats = BucketStats()
+        self.configure(count=count, window=window, burst=burst)
+
+    def configure(self, count: float, window: float, burst: int = 1) -> None:
+        """Allow count requests per window with the given burst size, zero means no limit."""
+        interval = window / count if count and window and count > 0 and window > 0 else 0.0
+        burst = max(int(burst or 1), 1)
+        with self._lock:
+            if interval == self._base_interval and (burst - 1) * interval == self._tolerance:
+                return
+            self._base_interval = interval
+            self._interval = interval
+            self._tolerance = (burst - 1) * interval
+
+    def acquire(self) -> float:
+        """Wait for a token and return the time spent waiting."""
+        with self._lock:
+            now = time.monotonic()
+            # reserve the next free slot, later callers queue behind the reservation
+            start = max(now, self._arrival - self._tolerance)
+            self._arrival = max(self._arrival, start) + self._interval
+            self._stats.acquired += 1
+            wait = start - now
+            self._stats.waited += wait
+        if wait > 0:
+            log(f"Waiting {wait:.2f}s to respect rate limit.")
+            time.sleep(wait)
+        return wait
+
+    def throttle(self, retry_after: Optional[float] = None) -> None:
+        """Pause the bucket after the upstream answered with a throttling status."""
+        with self._lock:
+            self._strikes += 1
+            self._stats.throttled += 1
+            if retry_after is None:
+                retry_after = min(max(self._interval, 1.0) * 2 ** (self._strikes - 1), 60.0)
+            if self._base_interval:
+                # slow down until the upstream accepts requests again
+                self._interval = min(self._interval * 2, self._base_interval * 8)
+            self._arrival = max(self._arrival, time.monotonic() + retry_after + self._tolerance)
+        log(f"Upstream throttled, pausing for {retry_after:.2f}s.", level='WARNING')
+
+    def recover(self) -> None:
+        """Step back towards the configured rate after a successful request."""
+        if not self._strikes and self._interval == self._base_interval:
+            return
+        with self._lock:
+            self._strikes = 0
+            self._interval = max(self._base_interval, self._interval * 0.9)
+
+    def stats(self) -> dict:
+        """Return usage statistics of the bucket."""
+        with self._lock:
+            return {
+                'rate': round(1 / self._interval, 2) if self._interval else None,
+                'burst': int(round(self._tolerance / self._interval)) + 1 if self._interval else None,
+                'acquired': self._stats.acquired,
+                'throttled': self._stats.throttled,
+                'waited': round(self._stats.waited, 2),
+            }
+
+    @property
+    def interval(self) -> float:
+        return self._base_interval
+
+
+class RateLimiter(metaclass=SingletonMeta):
+    """Registry of token buckets shared by every request handler of an upstream."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._default_interval = max(float(os.environ.get('REQUEST_MIN_INTERVAL', '0.3')), 0)
+
+    def bucket(self, url: str) -> TokenBucket:
+        """Return the bucket of the upstream, unknown upstreams get the default interval."""
+        key = upstream_key(url)
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(count=1, window=self._default_interval)
+            return self._buckets[key]
+
+    def configure(self, url: str, count: float, window: float, burst: int = 1) -> None:
+        """Set the rate limit of the upstream, the last configuration wins."""
+        self.bucket(url).configure(count=count, window=window, burst=burst)
+
+    def stats(self) -> dict:
+        """Return usage statistics for every upstream."""
+        with self._lock:
+            buckets = dict(self._buckets)
+        return {key: bucket.stats() for key, bucket in buckets.items()}
+
+    def close(self) -> None:
+        """Log the usage of every upstream rate limit."""
+        log(f"Rate limiter stats: {self.stats()}")
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised when a request is rejected because the upstream circuit is open."""
+
+
+@dataclass
+class BreakerSettings:
+    """Consecutive failures which open a circuit and the seconds it stays open."""
+    threshold: int = 5
+    cooldown: float = 60.0
+
+    @classmethod
+    def from_env(cls) -> 'BreakerSettings':
+        """Return the settings configured by the environment."""
+        return cls(
+            threshold=max(int(os.environ.get('BREAKER_THRESHOLD', '5')), 1),
+            cooldown=max(float(os.environ.get('BREAKER_COOLDOWN', '60')), 0),
+        )
+
+
+@dataclass
+class BreakerCounters:
+    """Consecutive failures, trips and rejected requests of a circuit breaker."""
+    failures: int = 0
+    trips: int = 0
+    rejected: int = 0
+
+
+class Breaker:
+    """Circuit breaker state of an upstream, opens after consecutive failures."""
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, key: str, settings: BreakerSettings) -> None:
+        self._key = key
+        self._settings = settings
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._opened = 0.0
+        self._probing = False
+        self._counters = BreakerCounters()
+
+    def allow(self) -> bool:
+        """Check a request may be sent, an open circuit lets one probe through after the cool-down."""
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened >= self._settings.cooldown:
+                self._state = self.HALF_OPEN
+                self._probing = False
+                log(f"Circuit for '{self._key}' half-open, probing the upstream.", level='INFO')
+            if self._state == self.CLOSED or (self._state == self.HALF_OPEN and not self._probing):
+                self._probing = self._state == self.HALF_OPEN
+                return True
+            self._counters.rejected += 1
+            return False
+
+    def success(self) -> None:
+        """Record a successful request and close the circuit."""
+        with self._lock:
+            if self._state != self.CLOSED:
+                log(f"Circuit for '{self._key}' closed, upstream recovered.", level='INFO')
+            self._state = self.CLOSED
+            self._counters.failures = 0
+            self._probing = False
+
+    def failure(self) -> None:
+        """Record a failed request, open the circuit after too many consecutive failures."""
+        with self._lock:
+            self._counters.failures += 1
+            self._probing = False
+            failures = self._counters.failures
+            if self._state == self.HALF_OPEN or (self._state == self.CLOSED and failures >= self._settings.threshold):
+                self._state = self.OPEN
+                self._opened = time.monotonic()
+                self._counters.trips += 1
+                log(
+                    f"Circuit for '{self._key}' opened after {failures} failures, "
+                    f"failing fast for {self._settings.cooldown:.0f}s.",
+                    level='WARNING'
+                )
+
+    def stats(self) -> dict:
+        """Return the state and counters of the breaker."""
+        with self._lock:
+            return {
+                'state': self._state,
+                'failures': self._counters.failures,
+                'trips': self._counters.trips,
+                'rejected': self._counters.rejected,
+            }
+
+
+class CircuitBreaker(metaclass=SingletonMeta):
+    """Registry of circuit breakers shared by every request handler of an upstream."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._breakers = {}
+        self._settings = BreakerSettings.from_env()
+
+    def breaker(self, url: str) -> Breaker:
+        """Return the breaker of the upstream of the given url."""
+        key = upstream_key(url)
+        with self._lock:
+            if key not in self._breakers:
+                self._breakers[key] = Breaker(key=key, settings=self._settings)
+            return self._breakers[key]
+
+    def stats(self) -> dict:
+        """Return the breaker state for every upstream."""
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {key: breaker.stats() for key, breaker in breakers.items()}
+
+    def close(self) -> None:
+        """Log the breaker state of every upstream."""
+        log(f"Circuit breaker stats: {self.stats()}")
@@ -0,0 +1,136 @@
+"""This module provides a watcher for file changes in a directory."""
+
+import os
+import time
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+import threading
+from typing import Callable
+from cineflow.system.logger import log
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_EVENT = struct.Struct('iIII')
+
+
+class DirectoryWatcher:
+    """Call back when files with the watched suffixes change, uses inotify and falls back to polling."""
+
+    def __init__(
+        self, directory: str, callback: Callable, suffixes: tuple = ('.yaml', '.yml'), interval: float = 1.0
+    ) -> None:
+        self._directory = directory
+        self._callback = callback
+        self._suffixes = suffixes
+        self._interval = max(interval, 0.1)
+        self._mode = os.environ.get('FLOW_WATCH', 'auto').lower()
+        self._running = False
+        self._thread = None
+
+    def start(self) -> None:
+        """Start watching the directory."""
+        if self._mode == 'off' or (self._thread and self._thread.is_alive()):
+            return
+        self._running = True
+        fd = self._inotify() if self._mode != 'poll' else None
+        target = self._watch_inotify if fd is not None else self._watch_polling
+        self._thread = threading.Thread(target=target, args=(fd,), daemon=True, name="watcher")
+        self._thread.start()
+        log(f"Watching '{self._directory}' for changes with {'inotify' if fd is not None else 'polling'}.")
+
+    def stop(self) -> None:
+        """Stop watching the directory."""
+        self._running = False
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout=self._interval * 2)
+        self._thread = None
+
+    def _inotify(self) -> int | None:
+        """Return an inotify descriptor watching the directory, None when inotify is not available."""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            mask = (
+                IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+            )
+            if libc.inotify_add_watch(fd, os.fsencode(self._directory), mask) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            return fd
+        except (OSError, AttributeError) as e:
+            log(f"Inotify not available, polling '{self._directory}' for changes: {e}")
+            return None
+
+    def _watch_inotify(self, fd: int) -> None:
+        try:
+            while self._running:
+                if not select.select([fd], [], [], self._interval)[0]:
+                    continue
+                if self._changed(self._read_events(fd)):
+                    # let the writer finish before reading the files
+                    time.sleep(0.2)
+                    self._read_events(fd)
+                    self._notify()
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _read_events(fd: int) -> list:
+        """Read the pending events and return their file names."""
+        names = []
+        while True:
+            try:
+                data = os.read(fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return names
+                raise
+            offset = 0
+            while offset + IN_EVENT.size <= len(data):
+                _, mask, _, length = IN_EVENT.unpack_from(data, offset)
+                name = data[offset + IN_EVENT.size:offset + IN_EVENT.size + length].rstrip(b'\0')
+                names.append(os.fsdecode(name) if name else None)
+                offset += IN_EVENT.size + length
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    return names
+
+    def _changed(self, names: list) -> bool:
+        return any(name is None or name.endswith(self._suffixes) for name in names)
+
+    def _watch_polling(self, _fd: None = None) -> None:
+        snapshot = self._snapshot()
+        while self._running:
+            time.sleep(self._interval)
+            if (current := self._snapshot()) != snapshot:
+                snapshot = current
+                self._notify()
+
+    def _snapshot(self) -> dict:
+        """Return the modification time and size of the watched files."""
+        try:
+            with os.scandir(self._directory) as entries:
+                return {
+                    entry.name: (entry.stat().st_mtime_ns, entry.stat().st_size)
+                    for entry in entries
+                    if entry.is_file() and entry.name.endswith(self._suffixes)
+                }
+        except OSError:
+            return {}
+
+    def _notify(self) -> None:
+        try:
+            self._callback()
+        except Exception as e:  # pylint: disable=broad-except
+            log(f"Error handling changes in '{self._directory}': {e}", level='WARNING')
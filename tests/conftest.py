@@ -0,0 +1,25 @@
+"""Shared fixtures of the tests."""
+
+import pytest
+from cineflow.bases.singleton import SingletonMeta
+from cineflow.system.database import Database
+
+
+@pytest.fixture
+def make_database(tmp_path, monkeypatch):
+    """Return a factory of cache databases in a temporary directory, the environment configures them."""
+    databases = []
+
+    def make(**env) -> Database:
+        monkeypatch.setenv('CACHE_DIRECTORY', str(tmp_path))
+        for key, value in env.items():
+            monkeypatch.setenv(key, str(value))
+        SingletonMeta._instances.pop(Database, None)  # pylint: disable=protected-access
+        databases.append(Database())
+        return databases[-1]
+
+    yield make
+    for database in databases:
+        database.stop()
+        database.close()
+    SingletonMeta._instances.pop(Database, None)  # pylint: disable=protected-access
@@ -0,0 +1,79 @@
+"""Tests of the upstream circuit breakers."""
+
+import time
+import pytest
+import requests
+from cineflow.system.request import RequestHandler
+from cineflow.system.upstream import Breaker, BreakerSettings, CircuitBreaker
+
+
+def _breaker(threshold: int = 2, cooldown: float = 0.05) -> Breaker:
+    return Breaker(key='http://upstream.test', settings=BreakerSettings(threshold=threshold, cooldown=cooldown))
+
+
+def test_opens_after_consecutive_failures():
+    breaker = _breaker()
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert not breaker.allow()
+    assert breaker.stats() == {'state': 'open', 'failures': 2, 'trips': 1, 'rejected': 1}
+
+
+def test_success_resets_the_failures():
+    breaker = _breaker()
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert breaker.allow()
+
+
+def test_half_open_lets_one_probe_through():
+    breaker = _breaker()
+    breaker.failure()
+    breaker.failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.success()
+    assert breaker.stats()['state'] == 'closed'
+    assert breaker.allow()
+
+
+def test_failed_probe_opens_again():
+    breaker = _breaker()
+    breaker.failure()
+    breaker.failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.stats()['state'] == 'open'
+    assert not breaker.allow()
+
+
+@pytest.fixture(name='handler')
+def fixture_handler(monkeypatch):
+    monkeypatch.setenv('REQUEST_RETRIES', '0')
+    handler = RequestHandler(url='http://probe.test')
+    breaker = CircuitBreaker().breaker('http://probe.test')
+    for _ in range(5):
+        breaker.failure()
+    monkeypatch.setattr(breaker, '_settings', BreakerSettings(threshold=1, cooldown=0.05))
+    time.sleep(0.06)
+    return handler
+
+
+def test_probe_failing_outside_requests_does_not_stick(handler):
+    def broken(*_args, **_kwargs):
+        raise ValueError('broken response')
+
+    handler._attempt = broken  # pylint: disable=protected-access
+    with pytest.raises(ValueError):
+        handler._send('GET', 'http://probe.test/movies')  # pylint: disable=protected-access
+    breaker = CircuitBreaker().breaker('http://probe.test')
+    assert breaker.stats()['state'] == 'open'
+    time.sleep(0.06)
+    # the next probe is let through instead of being rejected forever
+    handler._attempt = lambda *_args, **_kwargs: requests.Response()  # pylint: disable=protected-access
+    assert handler._send('GET', 'http://probe.test/movies') is not None  # pylint: disable=protected-access
+    assert breaker.stats()['state'] == 'closed'
@@ -0,0 +1,21 @@
+"""Tests of the title matching between media lists."""
+
+import pytest
+from cineflow.system.matcher import MediaIndex
+from cineflow.system.misc import media_title, media_year
+
+
+@pytest.mark.parametrize('release, title, year', [
+    ('Spider-Man.No.Way.Home.2021', 'Spider-Man No Way Home', '2021'),
+    ('Spider-Man.No.Way.Home.2021.1080p.WEB-DL', 'Spider-Man No Way Home', '2021'),
+    ('Blade.Runner.2049.2017.2160p', 'Blade Runner 2049', '2017'),
+])
+def test_release_name_is_parsed(release, title, year):
+    assert media_title(release) == title
+    assert media_year(release) == year
+
+
+def test_release_name_matches_title():
+    release = 'Spider-Man.No.Way.Home.2021'
+    index = MediaIndex(items=[{'title': media_title(release), 'year': media_year(release)}], join='title')
+    assert index.find({'title': 'Spider-Man: No Way Home', 'year': 2021})
@@ -0,0 +1,56 @@
+"""Tests of the background refresh of stored media."""
+
+import time
+import pytest
+
+
+def _store(database, title: str, year: int = 2001, kind: str = 'movie') -> None:
+    database.store_media_many(source='tmdb', items=[{'title': title, 'year': year, 'kind': kind, 'tmdbid': title}])
+    database.flush()
+    # the refresh takes the oldest media first
+    time.sleep(0.01)
+
+
+@pytest.fixture(name='database')
+def fixture_database(make_database):
+    return make_database(MEDIA_REFRESH_AGE=1, MEDIA_REFRESH_BUDGET=1)
+
+
+def test_failed_refresh_backs_off(database):
+    _store(database, title='Gone')
+    _store(database, title='Found')
+    time.sleep(1.1)
+    calls = []
+
+    def refresh(data):
+        calls.append(data['title'])
+        return None if data['title'] == 'Gone' else {**data, 'poster': 'new'}
+
+    database.register_media_refresh(source='tmdb', func=refresh, kind='movie')
+    database._refresh_media()  # pylint: disable=protected-access
+    database._refresh_media()  # pylint: disable=protected-access
+    database.flush()
+    assert calls == ['Gone', 'Found']
+    assert database.get_media(source='tmdb', title='Found', year=2001, kind='movie')['poster'] == 'new'
+
+
+def test_refresh_keeps_stored_key(database):
+    _store(database, title='Stored Title')
+    time.sleep(1.1)
+    database.register_media_refresh(source='tmdb', func=lambda data: {**data, 'title': 'Mapped Title'}, kind='movie')
+    database._refresh_media()  # pylint: disable=protected-access
+    database.flush()
+    assert database.get_media(source='tmdb', title='Stored Title', year=2001, kind='movie')['title'] == 'Mapped Title'
+    assert database.get_media(source='tmdb', title='Mapped Title', year=2001, kind='movie') is None
+
+
+def test_refresher_per_kind(database):
+    _store(database, title='Show', kind='tv')
+    time.sleep(1.1)
+    calls = []
+    for kind in ('movie', 'tv'):
+        database.register_media_refresh(
+            source='tmdb', func=lambda data, kind=kind: calls.append((kind, data['title'])), kind=kind
+        )
+    database._refresh_media()  # pylint: disable=protected-access
+    assert calls == [('tv', 'Show')]
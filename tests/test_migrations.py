@@ -0,0 +1,54 @@
+"""Tests of the schema migrations of the cache database."""
+
+import sqlite3
+import time
+from cineflow.system.codec import get_codec
+
+
+def _legacy(data: dict) -> bytes:
+    codec = get_codec(tag=0)
+    return codec.pack(codec.serialize(data))
+
+
+def _create_unversioned(path: str) -> None:
+    """Create a cache database as written before the schema versioning."""
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE media (title TEXT NOT NULL, year INTEGER NOT NULL, kind TEXT NOT NULL, "
+        "source TEXT NOT NULL, data BLOB NOT NULL, added REAL NOT NULL);"
+    )
+    conn.execute("CREATE TABLE request (hash TEXT NOT NULL PRIMARY KEY, data BLOB NOT NULL, added REAL NOT NULL);")
+    now = time.time()
+    for added, poster in ((now - 20, 'old'), (now - 10, 'new')):
+        conn.execute(
+            "INSERT INTO media VALUES (?, ?, ?, ?, ?, ?);",
+            ('Heat', 1995, 'movie', 'tmdb', _legacy({'title': 'Heat', 'year': 1995, 'poster': poster}), added)
+        )
+    conn.execute("INSERT INTO request VALUES (?, ?, ?);", ('abc', _legacy({'id': 1}), now))
+    conn.commit()
+    conn.close()
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> set:
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table});").fetchall()}
+
+
+def test_unversioned_database_is_migrated(tmp_path, make_database):
+    path = tmp_path / 'cachedb.sqlite3'
+    _create_unversioned(str(path))
+    database = make_database()
+    database.flush()
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("PRAGMA user_version;").fetchone()[0] == 4
+        assert {'codec', 'accessed', 'tmdbid'} <= _columns(conn, 'media')
+        assert {'etag', 'modified', 'codec', 'accessed'} <= _columns(conn, 'request')
+        assert conn.execute("SELECT COUNT(*) FROM media;").fetchone()[0] == 1
+    assert database.get_media(source='tmdb', title='Heat', year=1995, kind='movie')['poster'] == 'new'
+    assert database.get_request(rhash='abc') == {'id': 1}
+
+
+def test_migrated_database_is_not_migrated_again(tmp_path, make_database):
+    _create_unversioned(str(tmp_path / 'cachedb.sqlite3'))
+    make_database().close()
+    database = make_database()
+    assert database.get_media(source='tmdb', title='Heat', year=1995, kind='movie')['poster'] == 'new'
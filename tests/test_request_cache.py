@@ -0,0 +1,27 @@
+"""Tests of the request cache of the database."""
+
+import time
+from cineflow.system.database import CachedRequest
+
+
+def test_touch_keeps_evicted_entry(make_database):
+    database = make_database()
+    database.store_request(rhash='abc', data={'id': 1}, etag='"v1"', expire=60)
+    database.flush()
+    database._memory.pop('abc')  # pylint: disable=protected-access
+    stale = CachedRequest(data={'id': 1}, added=time.time() - 120, etag='"v1"')
+    database.touch_request(rhash='abc', entry=stale, expire=60)
+    assert database.get_request(rhash='abc', expire=60) == {'id': 1}
+
+
+def test_touch_without_memory_is_fresh_before_commit(make_database):
+    database = make_database(CACHE_MEMORY_SIZE=0)
+    database.store_request(rhash='abc', data={'id': 1}, etag='"v1"', expire=60)
+    assert database.get_request(rhash='abc', expire=60) == {'id': 1}
+    database.flush()
+    stale = CachedRequest(data={'id': 1}, added=time.time() - 120, etag='"v1"')
+    database.touch_request(rhash='abc', entry=stale, expire=60)
+    assert database.get_request(rhash='abc', expire=60) == {'id': 1}
+    database.flush()
+    assert not database._unflushed  # pylint: disable=protected-access
+    assert database.get_request(rhash='abc', expire=60) == {'id': 1}
@@ -0,0 +1,79 @@
+"""Tests of the item streams between flow steps."""
+
+import threading
+import pytest
+from cineflow.system.runner import Flow
+from cineflow.system.stream import Stream, StreamOptions
+
+
+def _plan(steps: list) -> tuple:
+    flow = Flow.__new__(Flow)
+    return flow._build_plan(steps=steps)  # pylint: disable=protected-access
+
+
+def test_stream_yields_chunks():
+    stream = Stream(name='numbers', source=[[1, 2, 3], [4, 5]], func=lambda chunk: chunk,
+                    options=StreamOptions(chunk=2))
+    assert list(stream) == [[1, 2], [3], [4, 5]]
+
+
+def test_stream_is_consumed_once():
+    stream = Stream(name='numbers', source=[[1]], func=lambda chunk: chunk)
+    stream.drain()
+    with pytest.raises(ValueError):
+        list(stream)
+
+
+def test_close_wakes_blocked_consumer():
+    release = threading.Event()
+    stream = Stream(name='blocked', source=[[1]], func=lambda chunk: release.wait(10) and chunk)
+    items = []
+    consumer = threading.Thread(target=lambda: items.extend(stream.flatten()), daemon=True)
+    consumer.start()
+    stream.close()
+    consumer.join(timeout=3)
+    release.set()
+    assert not consumer.is_alive()
+    assert not items
+
+
+def test_close_closes_upstream():
+    release = threading.Event()
+    upstream = Stream(name='source', source=[[1]], func=lambda chunk: release.wait(10) and chunk)
+    stream = Stream(name='sink', source=upstream, func=lambda chunk: chunk,
+                    options=StreamOptions(upstream=upstream))
+    stream.close()
+    stream._thread.join(timeout=3)  # pylint: disable=protected-access
+    release.set()
+    assert not stream._thread.is_alive()  # pylint: disable=protected-access
+
+
+def test_plan_rejects_second_stream_consumer():
+    steps = [
+        {'name': 'search', 'module': 'tmdb', 'action': 'get', 'stream': True},
+        {'name': 'first', 'module': 'library', 'action': 'unique', 'input': {'data': '{{search}}'}},
+        {'name': 'second', 'module': 'library', 'action': 'common', 'input': {'data': '{{search}}'}},
+    ]
+    with pytest.raises(ValueError, match='only one step'):
+        _plan(steps)
+
+
+def test_plan_rejects_after_streaming_step():
+    steps = [
+        {'name': 'search', 'module': 'tmdb', 'action': 'get', 'stream': True},
+        {'name': 'filter', 'module': 'library', 'action': 'unique', 'input': {'data': '{{search}}'}},
+        {'name': 'report', 'module': 'library', 'action': 'get', 'after': 'search'},
+    ]
+    with pytest.raises(ValueError, match='after streaming step'):
+        _plan(steps)
+
+
+def test_plan_allows_after_consumed_stream():
+    steps = [
+        {'name': 'search', 'module': 'tmdb', 'action': 'get', 'stream': True},
+        {'name': 'filter', 'module': 'library', 'action': 'unique', 'input': {'data': '{{search}}'}, 'after': 'search'},
+        {'name': 'report', 'module': 'library', 'action': 'get', 'after': 'filter'},
+    ]
+    _, depends, sources = _plan(steps)
+    assert sources == [None, 0, None]
+    assert depends[2] == {1}